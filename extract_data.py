@@ -1,7 +1,8 @@
 """ extract_data.py
     ------------------
     This script constructs the command line interface which is used to extract, clean and manage trade data for selected symbols, dates and
-    times from the wrds database.
+    times from the wrds database. The stages of the extraction are functions which can be imported and run from another script or notebook:
+    the command line interface only parses the arguments and runs them in sequence in main().
 
     Contact: nicolo.ceneda@student.unisg.ch
     Last update: 18 May 2020
@@ -13,47 +14,30 @@
 # ------------------------------------------------------------------------------------------------------------------------------------------
 
 
-# Import the libraries
+# Import the libraries: matplotlib, pandas_market_calendars and wrds are imported only by the stages which need them
 
 import os
+import sys
 import time
+import queue
+import threading
+import random
 import argparse
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-import pandas_market_calendars as mcal
-import matplotlib.pyplot as plt
-
-
-# Establish a connection to the wrds cloud
-
-try:
-
-    import wrds
-
-except ImportError:
-
-    raise ImportError('\nAn error occurred trying to import the wrds library locally: run the script on the wrds cloud.')
-
-else:
-
-    db = wrds.Connection()
 
 
 # Import the functions from the functions script
 
-from extract_data_functions import section, graph_output, graph_comparison, print_output
-
-
-# Set the displayed size of pandas objects
-
-pd.set_option('display.max_rows', None)
-pd.set_option('display.max_columns', None)
-pd.set_option('display.width', None)
-
-
-# Start timing the execution
-
-start = time.time()
+from extract_data_functions import section, graph_output, graph_comparison, graph_backend_agg, print_output, cache_path, read_cache, write_cache, set_query_timeout, list_tables_cached, \
+                                   schedule_cached, compact_trades, concat_trades, set_stream_results, stream_trades, \
+                                   memory_footprint, partition_path, read_manifest, write_manifest_entry, check_checkpoint_run, shard_units, \
+                                   filter_outliers_timed, partition_index, partition_slice, write_dataset, build_bars, \
+                                   count_empty_buckets, dataset_dates, read_dataset_params, write_dataset_params, asof_join_quotes, \
+                                   trade_signs, write_trades_quotes, record_stage, write_metrics, realized_features, build_event_bars, \
+                                   write_catalog, encode_conditions, policy_mask, common_bucket, rollback_query
 
 
 # ------------------------------------------------------------------------------------------------------------------------------------------
@@ -79,102 +63,269 @@ parser.add_argument('-et', '--end_time', metavar='', type=str, default='{}'.form
 parser.add_argument('-bg', '--debug', action='store_true', help='Flag to debug the program.')
 parser.add_argument('-po', '--print_output', action='store_true', help='Flag to print the output.')
 parser.add_argument('-go', '--graph_output', action='store_true', help='Flag to graph the output.')
+parser.add_argument('-gd', '--graph_decimate', action='store_true', help='Flag to decimate the graphs to the width of each subplot.')
+parser.add_argument('-gp', '--graph_processes', metavar='', type=int, default=1, help='Number of processes to render the graphs in parallel.')
+parser.add_argument('-bq', '--batch_query', action='store_true', help='Flag to query all the symbols of a date at once.')
+parser.add_argument('-nw', '--n_workers', metavar='', type=int, default=1, help='Number of concurrent connections to run the queries.')
+parser.add_argument('-qt', '--query_timeout', metavar='', type=int, default=None, help='Timeout of each query in seconds.')
+parser.add_argument('-ma', '--max_attempts', metavar='', type=int, default=2, help='Max number of attempts to run each query.')
+parser.add_argument('-bo', '--backoff', metavar='', type=float, default=1.0, help='Base delay in seconds before a failed query is run again.')
+parser.add_argument('-fc', '--fetch_chunksize', metavar='', type=int, default=500000, help='Number of trades streamed in each chunk: 0 to disable.')
+parser.add_argument('-pu', '--pushdown', metavar='', type=str, default='none', choices=['none', 'ticks', 'bars'], help='Aggregation run by the database.')
+parser.add_argument('-fk', '--fetch_conditions', action='store_true', help='Fetch all the condition codes once and filter them locally.')
+parser.add_argument('-fp', '--filter_policy', metavar='', type=str, default='default', help='Filter policy of the condition codes.')
+parser.add_argument('-pd', '--price_dtype', metavar='', type=str, default='float64', choices=['float32', 'float64'], help='Dtype of the prices.')
+parser.add_argument('-np', '--n_processes', metavar='', type=int, default=1, help='Number of processes to clean the symbols in parallel.')
+parser.add_argument('-cd', '--cache_dir', metavar='', type=str, default=None, help='Directory of the local cache of queried trades.')
+parser.add_argument('-cp', '--checkpoint_dir', metavar='', type=str, default=None, help='Directory of the checkpoints to resume the extraction.')
+parser.add_argument('-ct', '--catalog_dir', metavar='', type=str, default=None, help='Directory of the local catalog of tables and calendars.')
+parser.add_argument('-ce', '--catalog_expiry', metavar='', type=float, default=24, help='Hours after which the local catalog expires.')
+parser.add_argument('-of', '--output_format', metavar='', type=str, default='csv', choices=['csv', 'parquet'], help='Format of the exported datasets.')
+parser.add_argument('-ap', '--append', action='store_true', help='Extract only the dates not yet stored in the datasets and merge them.')
+parser.add_argument('-rs', '--reselect', action='store_true', help='Select k, y and the frequency again when appending to the datasets.')
+parser.add_argument('-qu', '--quotes', action='store_true', help='Join the cleaned trades to the prevailing national best bid and offer.')
+parser.add_argument('-qc', '--quote_chunksize', metavar='', type=int, default=100000, help='Number of quotes streamed in each chunk.')
+parser.add_argument('-bt', '--bar_type', metavar='', type=str, default='time', choices=['time', 'tick', 'volume', 'dollar'], help='Type of bars.')
+parser.add_argument('-bs', '--bar_size', metavar='', type=float, default=None, help='Number of trades, shares or dollars of each event bar.')
+parser.add_argument('-mf', '--metrics_file', metavar='', type=str, default=None, help='Json or csv file of the metrics of each stage.')
+parser.add_argument('-sy', '--synthetic_dir', metavar='', type=str, default=None, help='Directory of a synthetic database to query offline.')
+parser.add_argument('-ns', '--n_shards', metavar='', type=int, default=1, help='Number of shards of the queries, run as separate array tasks.')
+parser.add_argument('-si', '--shard_id', metavar='', type=int, default=None, help='Shard run by this task, from 1: defaults to $SGE_TASK_ID.')
+parser.add_argument('-mg', '--merge', action='store_true', help='Merge the checkpoints of the shards and run the remaining stages.')
+
+
+# Create a function to parse the arguments of the command line, or of a list of arguments, and apply the debug settings
+
+def parse_args(argv_=None):
+
+    args_ = parser.parse_args(argv_)
+
+    if args_.debug:
+
+        args_.symbol_list = ['AAPL', 'AMZN', 'GOOG', 'TSLA']
+        args_.start_date = '2019-03-28'
+        args_.end_date = '2019-04-02'
+        args_.start_time = '09:38:00'
+        args_.end_time = '09:48:00'
+        args_.print_output = True
+        args_.graph_output = True
+        args_.graph_decimate = True
+
+    return args_
+
+
+# Create a function to check the availability of the libraries required by the optional settings
+
+def check_libraries(args_):
+
+    if args_.cache_dir is not None or args_.checkpoint_dir is not None or args_.output_format == 'parquet' or args_.quotes:
+
+        try:
+
+            import pyarrow
+
+        except ImportError:
+
+            raise ImportError('\nAn error occurred trying to import the pyarrow library: install it to use the local cache, the checkpoints, '
+                              'the parquet output or the quotes.')
+
+
+# Create a function to check the settings of a run split in shards: the shards and the merge step share the directory of the checkpoints
+
+def check_shards(args_):
+
+    if args_.n_shards > 1 and not args_.merge:
+
+        if args_.shard_id is None:
+
+            if not os.environ.get('SGE_TASK_ID', '').isdigit():
+
+                raise ValueError('Missing shard id: set it with -si or run the shards as the tasks of an SGE array job.')
+
+            args_.shard_id = int(os.environ['SGE_TASK_ID'])
+
+        if not 1 <= args_.shard_id <= args_.n_shards:
+
+            raise ValueError('Invalid shard id: choose an id between 1 and {}.'.format(args_.n_shards))
+
+    if (args_.n_shards > 1 or args_.merge) and args_.checkpoint_dir is None:
+
+        raise ValueError('Missing checkpoint directory: the shards and the merge step share their partitions and manifests in -cp.')
+
+
+# Create a function to establish a connection to the wrds cloud, or to the local synthetic database generated by 'synthetic_taq.py'
+
+def connect_db(args_):
+
+    if args_.synthetic_dir is not None:
+
+        import synthetic_taq
+
+        return synthetic_taq.Connection(args_.synthetic_dir)
+
+    try:
+
+        import wrds
+
+    except ImportError:
+
+        raise ImportError('\nAn error occurred trying to import the wrds library locally: run the script on the wrds cloud or on a synthetic '
+                          'database with -sy.')
+
+    return wrds.Connection()
+
+
+# Create a function to check the validity of the input symbols, dates and times and create the lists of symbols and dates
+
+def check_input(args_, metrics_):
+
+    # Check the validity of the input symbols and create the list of symbols:
+
+    symbol_list = list(args_.symbol_list)
+
+    unwanted_symbols = ['GOOG', 'LBTYA', 'FOX']
+    wanted_symbols = ['GOOG', 'LBTY', 'FOXA']
+    wanted_symbols_suffix = {'GOOG': ('L', "='L'"), 'LBTY': ('K', "='K'"), 'FOXA': ('', "is null")}
+
+    suffix_query = {symbol: "is null" for symbol in symbol_list if symbol not in unwanted_symbols}
+
+    for pos, unwanted_symbol in enumerate(unwanted_symbols):
+
+        if unwanted_symbol in symbol_list:
+
+            wanted_symbol = wanted_symbols[pos]
+            wanted_suffix = wanted_symbols_suffix[wanted_symbol][0]
+            symbol_list[symbol_list.index(unwanted_symbol)] = wanted_symbol
+            suffix_query[wanted_symbol] = wanted_symbols_suffix[wanted_symbol][1]
+            print('\n*** WARNING: You attempted to query {}: {} has been selected instead as it is more liquid.'.format(unwanted_symbol,
+                  wanted_symbol + wanted_suffix))
+
+    # Check the validity of the input start and end dates and create the list of dates:
 
-args = parser.parse_args()
+    if args_.start_date > args_.end_date:
 
+        raise ValueError('Invalid start and end dates: chose a start date before the end date.')
 
-# Define the debug settings
+    elif args_.start_date < min_start_date and args_.end_date < max_end_date:
 
-if args.debug:
+        raise ValueError('Invalid start date: choose a date after {}.'.format(min_start_date))
 
-    args.symbol_list = ['AAPL', 'AMZN', 'GOOG', 'TSLA']
-    args.start_date = '2019-03-28'
-    args.end_date = '2019-04-02'
-    args.start_time = '09:38:00'
-    args.end_time = '09:48:00'
-    args.print_output = True
-    args.graph_output = True
+    elif args_.start_date > min_start_date and args_.end_date > max_end_date:
 
-    section('You are debugging with: symbol_list: {} | start_date: {} | end_date: {} | start_time: {} | end_time: {}'.format(args.symbol_list,
-            args.start_date, args.end_date, args.start_time, args.end_time))
+        raise ValueError('Invalid end date: choose a date before {}.'.format(max_end_date))
 
-else:
+    elif args_.start_date < min_start_date and args_.end_date > max_end_date:
 
-    section('You are querying with: symbol_list: {} | start_date: {} | end_date: {} | start_time: {} | end_time: {}'.format(args.symbol_list,
-            args.start_date, args.end_date, args.start_time, args.end_time))
+        raise ValueError('Invalid start and end dates: choose dates between {} and {}.'.format(min_start_date, max_end_date))
 
+    start_stage = time.time()
+    date_index = schedule_cached('NASDAQ', args_.start_date, args_.end_date, args_.catalog_dir, args_.catalog_expiry)
+    record_stage(metrics_, 'catalog', '', '', start_stage, 0, len(date_index))
+    date_list = [str(d)[:10].replace('-', '') for d in date_index]
 
-# Check the validity of the input symbols and create the list of symbols:
+    # Check the validity of the input times:
 
-symbol_list = args.symbol_list
+    if args_.start_time > args_.end_time:
 
-unwanted_symbols = ['GOOG', 'LBTYA', 'FOX']
-wanted_symbols = ['GOOG', 'LBTY', 'FOXA']
-wanted_symbols_suffix = {'GOOG': ('L', "='L'"), 'LBTY': ('K', "='K'"), 'FOXA': ('', "is null")}
+        raise ValueError('Invalid start and end times: chose a start time before the end time.')
 
-suffix_query = {symbol: "is null" for symbol in symbol_list if symbol not in unwanted_symbols}
+    elif args_.start_time < min_start_time and args_.end_time < max_end_time:
 
-for pos, unwanted_symbol in enumerate(unwanted_symbols):
+        raise ValueError('Invalid start time: choose a time after {}.'.format(min_start_time))
 
-    if unwanted_symbol in symbol_list:
+    elif args_.start_time > min_start_time and args_.end_time > max_end_time:
 
-        wanted_symbol = wanted_symbols[pos]
-        wanted_suffix = wanted_symbols_suffix[wanted_symbol][0]
-        symbol_list[symbol_list.index(unwanted_symbol)] = wanted_symbol
-        suffix_query[wanted_symbol] = wanted_symbols_suffix[wanted_symbol][1]
-        print('\n*** WARNING: You attempted to query {}: {} has been selected instead as it is more liquid.'.format(unwanted_symbol,
-              wanted_symbol + wanted_suffix))
+        raise ValueError('Invalid end time: choose a time before {}.'.format(max_end_time))
 
+    elif args_.start_time < min_start_time and args_.end_time > max_end_time:
 
-# Check the validity of the input start and end dates and create the list of dates:
+        raise ValueError('Invalid start and end times: choose times between {} and {}.'.format(min_start_time, max_end_time))
 
-if args.start_date > args.end_date:
+    # Check the validity of the input bars:
 
-    print('\n*** ERROR: Invalid start and end dates: chose a start date before the end date.')
-    exit()
+    if args_.bar_type != 'time' and (args_.bar_size is None or args_.bar_size <= 0):
 
-elif args.start_date < min_start_date and args.end_date < max_end_date:
+        raise ValueError('Invalid bar size: choose a positive number of trades, shares or dollars for each {} bar.'.format(args_.bar_type))
 
-    print('\n*** ERROR: Invalid start date: choose a date after {}.'.format(min_start_date))
-    exit()
+    # Check the validity of the input filter policy:
 
-elif args.start_date > min_start_date and args.end_date > max_end_date:
+    if args_.filter_policy not in filter_policies:
 
-    print('\n*** ERROR: Invalid end date: choose a date before {}.'.format(max_end_date))
-    exit()
+        raise ValueError('Invalid filter policy: choose one of {}.'.format(list(filter_policies)))
 
-elif args.start_date < min_start_date and args.end_date > max_end_date:
+    elif args_.filter_policy != 'default' and not args_.fetch_conditions:
 
-    print('\n*** ERROR: Invalid start and end dates: choose dates between {} and {}.'.format(min_start_date, max_end_date))
-    exit()
+        raise ValueError('Invalid filter policy: fetch the condition codes with -fk to apply a policy other than the default one.')
 
-nasdaq = mcal.get_calendar('NASDAQ')
-nasdaq_cal = nasdaq.schedule(start_date=args.start_date, end_date=args.end_date)
-date_index = nasdaq_cal.index
-date_list = [str(d)[:10].replace('-', '') for d in date_index]
+    elif args_.fetch_conditions and args_.pushdown != 'none':
 
+        raise ValueError('Invalid pushdown: the condition codes can only be fetched with the trades not aggregated by the database.')
 
-# Check the validity of the input times:
+    elif args_.pushdown == 'bars' and args_.bar_type != 'time':
 
-if args.start_time > args.end_time:
+        raise ValueError('Invalid pushdown: the {} bars are built from the trades, not from the time bars of the database.'.format(
+                         args_.bar_type))
 
-    print('\n*** ERROR: Invalid start and end times: chose a start time before the end time.')
-    exit()
+    return symbol_list, suffix_query, date_index, date_list
 
-elif args.start_time < min_start_time and args.end_time < max_end_time:
 
-    print('\n*** ERROR: Invalid start time: choose a time after {}.'.format(min_start_time))
-    exit()
+# Create a function to get the directory of the datasets
 
-elif args.start_time > min_start_time and args.end_time > max_end_time:
+def dataset_root(args_):
 
-    print('\n*** ERROR: Invalid end time: choose a time before {}.'.format(max_end_time))
-    exit()
+    return 'data/mode bg/datasets' if args_.debug else 'data/mode sl/datasets'
 
-elif args.start_time < min_start_time and args.end_time > max_end_time:
 
-    print('\n*** ERROR: Invalid start and end times: choose times between {} and {}.'.format(min_start_time, max_end_time))
-    exit()
+# Create a function to restrict the list of dates to the dates not yet stored in the datasets and load the parameters of the stored datasets
+
+def select_new_dates(args_, symbol_list_, date_index_, date_list_):
+
+    dataset_params = {}
+
+    if not args_.append:
+
+        return date_index_, date_list_, dataset_params
+
+    stored_dates = {symbol: set(dataset_dates(os.path.join(dataset_root(args_), symbol), args_.output_format)) for symbol in symbol_list_}
+    date_list = [d for d in date_list_ if any('{}-{}-{}'.format(d[:4], d[4:6], d[6:]) not in stored_dates[s] for s in symbol_list_)]
+    date_index = date_index_[[str(d)[:10].replace('-', '') in date_list for d in date_index_]]
+
+    if len(date_list) == 0:
+
+        return date_index, date_list, dataset_params
+
+    print('Appending the dates {} to the datasets.'.format(date_list))
+
+    for symbol in symbol_list_:
+
+        params = read_dataset_params(os.path.join(dataset_root(args_), symbol))
+
+        if len(stored_dates[symbol]) == 0 or args_.reselect:
+
+            continue
+
+        if params is None:
+
+            raise ValueError('Could not find the parameters of the dataset of {}: append with -rs to select them again.'.format(symbol))
+
+        if params['start_time'] != args_.start_time or params['end_time'] != args_.end_time:
+
+            raise ValueError('Invalid start and end times: the dataset of {} was extracted between {} and {}.'.format(symbol,
+                             params['start_time'], params['end_time']))
+
+        if params.get('bar_type', 'time') != args_.bar_type or params.get('bar_size') != args_.bar_size:
+
+            raise ValueError('Invalid bars: the dataset of {} was built with {} bars of size {}.'.format(symbol, params.get('bar_type', 'time'),
+                             params.get('bar_size')))
+
+        if params.get('filter_policy', 'default') != args_.filter_policy:
+
+            raise ValueError('Invalid filter policy: the dataset of {} was filtered with the policy {}.'.format(symbol,
+                             params.get('filter_policy', 'default')))
+
+        dataset_params[symbol] = params
+
+    return date_index, date_list, dataset_params
 
 
 # ------------------------------------------------------------------------------------------------------------------------------------------
@@ -182,40 +333,121 @@ elif args.start_time < min_start_time and args.end_time > max_end_time:
 # ------------------------------------------------------------------------------------------------------------------------------------------
 
 
-# Create a function to run the SQL query and filter for unwanted 'tr_corr' and 'tr_scond'
+# Define the filters for unwanted 'tr_corr' and 'tr_scond'
+
+tr_corr_keep = '00'
+tr_scond_drop = ['G', 'L', 'P', 'T', 'U', 'X', 'Z']
+
+
+# Define the named filter policies applied locally to the trades fetched with all their condition codes: each policy keeps the trades with
+# a 'tr_corr' in 'tr_corr_keep' and without any 'tr_scond' in 'tr_scond_drop'; the 'default' policy is the filter of the SQL query, the
+# 'regular' policy also discards the opening, closing and derivatively priced prints, the 'round_lot' policy also discards the odd lots
+# and the 'corrected' policy also keeps the corrections of the trades
 
-def query_sql(date_, symbol_, start_time_, end_time_):
+filter_policies = {'default': {'tr_corr_keep': [tr_corr_keep], 'tr_scond_drop': tr_scond_drop},
+                   'regular': {'tr_corr_keep': [tr_corr_keep], 'tr_scond_drop': tr_scond_drop + ['4', '5', '6', 'M', 'O', 'Q']},
+                   'round_lot': {'tr_corr_keep': [tr_corr_keep], 'tr_scond_drop': tr_scond_drop + ['4', '5', '6', 'I', 'M', 'O', 'Q']},
+                   'corrected': {'tr_corr_keep': [tr_corr_keep, '12'], 'tr_scond_drop': tr_scond_drop}}
 
-    max_attempts = 2
 
-    parm = {'G': '%G%', 'L': '%L%', 'P': '%P%', 'T': '%T%', 'U': '%U%', 'X': '%X%', 'Z': '%Z%'}
+# Create a function to write the SQL query for one or more symbols on a date, sorted by symbol and time, and filter for unwanted 'tr_corr'
+# and 'tr_scond', unless filter_ is False: with the pushdown 'ticks', the database aggregates the simultaneous trades to their median
+# price, total size and count; with the pushdown 'bars', it also keeps only the last aggregated trade of each bucket of freq_, with the
+# total size and count of the bucket
 
-    query = "SELECT date, time_m, sym_root, sym_suffix, tr_scond, size, price, tr_corr " \
-            "FROM taqm_{}.ctm_{} " \
-            "WHERE sym_root = '{}' " \
-            "AND sym_suffix {} " \
+def write_query(date_, symbols_, suffix_query_, start_time_, end_time_, pushdown_='none', freq_=None, filter_=True):
+
+    if len(symbols_) == 1:
+
+        symbol_condition = "sym_root = '{}' AND sym_suffix {} ".format(symbols_[0], suffix_query_[symbols_[0]])
+
+    else:
+
+        symbol_condition = "sym_root IN ({}) AND ({}) ".format(", ".join("'{}'".format(s) for s in symbols_),
+                           " OR ".join("(sym_root = '{}' AND sym_suffix {})".format(s, suffix_query_[s]) for s in symbols_))
+
+    query_condition = "FROM taqm_{}.ctm_{} " \
+                      "WHERE {}" \
+                      "AND time_m >= '{}' " \
+                      "AND time_m <= '{}' ".format(date_[:4], date_, symbol_condition, start_time_, end_time_)
+
+    if not filter_:
+
+        return "SELECT date, time_m, sym_root, sym_suffix, tr_scond, size, price, tr_corr " + query_condition + \
+               "ORDER BY sym_root, time_m", {}
+
+    query_condition += "AND tr_corr = '{}' ".format(tr_corr_keep) + \
+                       " ".join("AND tr_scond NOT LIKE %({})s".format(cond) for cond in tr_scond_drop)
+
+    parm = {cond: '%{}%'.format(cond) for cond in tr_scond_drop}
+
+    if pushdown_ == 'none':
+
+        return "SELECT date, time_m, sym_root, sym_suffix, tr_scond, size, price, tr_corr " + query_condition + \
+               " ORDER BY sym_root, time_m", parm
+
+    query = "SELECT date, time_m, sym_root, sym_suffix, PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY price) AS price, " \
+            "CAST(SUM(size) AS bigint) AS size, COUNT(*) AS count " + query_condition + \
+            " GROUP BY date, time_m, sym_root, sym_suffix"
+
+    if pushdown_ == 'bars':
+
+        bucket = "CEIL(EXTRACT(EPOCH FROM time_m) / {})".format(pd.Timedelta(freq_).total_seconds())
+
+        query = "SELECT date, time_m, sym_root, sym_suffix, price, size, count " \
+                "FROM (SELECT date, time_m, sym_root, sym_suffix, price, " \
+                "CAST(SUM(size) OVER bucket_window AS bigint) AS size, " \
+                "CAST(SUM(count) OVER bucket_window AS bigint) AS count, " \
+                "ROW_NUMBER() OVER (PARTITION BY sym_root, sym_suffix, {0} ORDER BY time_m DESC) AS pos_last " \
+                "FROM ({1}) AS ticks " \
+                "WINDOW bucket_window AS (PARTITION BY sym_root, sym_suffix, {0})) AS bars " \
+                "WHERE pos_last = 1".format(bucket, query)
+
+    return query + " ORDER BY sym_root, time_m", parm
+
+
+# Create a function to write the SQL query of the national best bid and offer of a symbol on a date, sorted by time
+
+def write_quote_query(date_, symbol_, suffix_query_, end_time_):
+
+    query = "SELECT time_m, best_bid, best_ask " \
+            "FROM taqm_{}.complete_nbbo_{} " \
+            "WHERE sym_root = '{}' AND sym_suffix {} " \
             "AND time_m >= '{}' " \
             "AND time_m <= '{}' " \
-            "AND tr_corr = '00'" \
-            "AND tr_scond NOT LIKE %(G)s " \
-            "AND tr_scond NOT LIKE %(L)s " \
-            "AND tr_scond NOT LIKE %(P)s " \
-            "AND tr_scond NOT LIKE %(T)s " \
-            "AND tr_scond NOT LIKE %(U)s " \
-            "AND tr_scond NOT LIKE %(X)s " \
-            "AND tr_scond NOT LIKE %(Z)s ".format(date_[:4], date_, symbol_, suffix_query[symbol_], start_time_, end_time_)
+            "AND best_bid > 0 " \
+            "AND best_ask >= best_bid " \
+            "ORDER BY time_m".format(date_[:4], date_, symbol_, suffix_query_[symbol_], min_start_time, end_time_)
 
-    for attempt in range(max_attempts):
+    return query
+
+
+# Create a function to run the SQL query with exponential backoff and jitter between the attempts: with chunksize_, the rows are streamed in
+# chunks and decoded into compact columns, so that the memory of a query is bounded by the chunk rather than by the volume of the day
+
+def run_query(db_, query_, parm_, max_attempts_, backoff_, chunksize_=0, price_dtype_='float64'):
+
+    for attempt in range(max_attempts_):
 
         try:
 
-            queried_trades = db.raw_sql(query, params=parm)
+            if chunksize_ > 0:
+
+                queried_trades = stream_trades(db_.raw_sql(query_, params=parm_, chunksize=chunksize_, return_iter=True), price_dtype_)
+
+            else:
+
+                queried_trades = db_.raw_sql(query_, params=parm_)
 
         except Exception:
 
-            if attempt < max_attempts - 1:
+            rollback_query(db_)
 
-                print('\n*** WARNING: The query failed: trying again.')
+            if attempt < max_attempts_ - 1:
+
+                wait = backoff_ * 2 ** attempt * random.uniform(0.5, 1.5)
+                print('\n*** WARNING: The query failed: trying again in {:.1f} seconds.'.format(wait))
+                time.sleep(wait)
 
             else:
 
@@ -228,75 +460,429 @@ def query_sql(date_, symbol_, start_time_, end_time_):
     return None, False
 
 
-# Create a function to check the min and max number of observations for each symbol
+# Create a function to open the pool of connections used to run the queries: the results are streamed through a server-side cursor when
+# the trades are fetched in chunks, and always when the quotes are joined, whose memory is bounded only by the cursor
+
+def open_db_pool(args_):
+
+    db_list = [connect_db(args_) for _ in range(max(args_.n_workers, 1))]
+
+    for db_conn in db_list:
+
+        if args_.query_timeout is not None:
+
+            set_query_timeout(db_conn, args_.query_timeout)
+
+        if args_.fetch_chunksize > 0 or args_.quotes:
+
+            set_stream_results(db_conn)
+
+    return db_list
+
+
+# Create a function to run the SQL queries of the symbols on the dates, and compute the min and max number of observations for each symbol:
+# the lists of warnings are also stored in warnings_, if given
+
+def extract_trades(args_, db_list_, symbol_list_, suffix_query_, date_list_, dataset_params_, metrics_, warnings_=None):
+
+    # Create a function to locate the cached query of a symbol on a date: the prices are cached with the dtype of the run
+
+    def query_cache_file(date_, symbol_, start_time_, end_time_):
+
+        cache_key = (symbol_, suffix_query_[symbol_], date_, start_time_, end_time_, tr_corr_keep, tr_scond_drop)
+
+        if args_.fetch_conditions:
+
+            cache_key = (symbol_, suffix_query_[symbol_], date_, start_time_, end_time_, 'conditions')
+
+        elif args_.pushdown != 'none':
+
+            cache_key += (args_.pushdown, pushdown_freq)
+
+        cache_key += (args_.price_dtype,)
+
+        return cache_path(args_.cache_dir, date_, symbol_, cache_key)
+
+    # Create a function to query the trades of one or more symbols on a date and split them by symbol
+
+    def fetch_trades(db_, date_, symbols_, start_time_, end_time_):
+
+        if len(symbols_) > 1:
+
+            print('Running a batched query with: symbols: {}, date: {}.'.format(symbols_, pd.to_datetime(date_).strftime('%Y-%m-%d')))
+
+        start_stage = time.time()
+        query, parm = write_query(date_, symbols_, suffix_query_, start_time_, end_time_, args_.pushdown, pushdown_freq,
+                                  not args_.fetch_conditions)
+        queried_trades, success_query_sql = run_query(db_, query, parm, args_.max_attempts, args_.backoff, args_.fetch_chunksize,
+                                                      args_.price_dtype)
+
+        if not success_query_sql:
+
+            record_stage(metrics_, 'fetch', ' '.join(symbols_), date_, start_stage, 0, 0)
+
+            return {(symbol_, date_): None for symbol_ in symbols_}
+
+        if args_.fetch_conditions:
+
+            queried_trades = encode_conditions(queried_trades)
+
+        record_stage(metrics_, 'fetch', ' '.join(symbols_), date_, start_stage, 0, len(queried_trades),
+                     queried_trades.memory_usage(index=False, deep=True).sum())
+
+        queried_trades_split = dict(list(queried_trades.groupby('sym_root', sort=False, observed=True)))
+        fetched_trades = {}
+
+        for symbol_ in symbols_:
+
+            if symbol_ in queried_trades_split:
+
+                fetched_trades[(symbol_, date_)] = queried_trades_split[symbol_].reset_index(drop=True)
+
+            else:
+
+                fetched_trades[(symbol_, date_)] = queried_trades.iloc[:0]
+
+            if args_.cache_dir is not None:
+
+                write_cache(fetched_trades[(symbol_, date_)], query_cache_file(date_, symbol_, start_time_, end_time_))
+
+        return fetched_trades
+
+    # Create a function to check whether the query of a symbol on a date still has to be run
+
+    def is_pending(date_, symbol_, start_time_, end_time_):
+
+        if (symbol_, date_) in batch_trades or (symbol_, date_) in checkpoint_done:
+
+            return False
+
+        if units_shard is not None and (symbol_, date_) not in units_shard:
+
+            return False
+
+        return args_.cache_dir is None or not os.path.isfile(query_cache_file(date_, symbol_, start_time_, end_time_))
+
+    # Create a function to run the SQL query of a symbol on a date
+
+    def query_sql(date_, symbol_, start_time_, end_time_):
+
+        if (symbol_, date_) in checkpoint_done:
+
+            checkpoint_trades = read_cache(partition_path(args_.checkpoint_dir, 'query', symbol_, date_))
+
+            if checkpoint_trades is not None:
+
+                print('Reading the queried trades from the checkpoint.')
+
+                return checkpoint_trades, True
+
+            checkpoint_done.discard((symbol_, date_))
+
+        if (symbol_, date_) not in batch_trades:
+
+            if args_.cache_dir is not None:
+
+                cached_trades = read_cache(query_cache_file(date_, symbol_, start_time_, end_time_))
+
+                if cached_trades is not None:
+
+                    print('Reading the queried trades from the local cache.')
+
+                    return cached_trades, True
+
+            if args_.batch_query:
+
+                symbols = [s for s in symbol_list_[symbol_list_.index(symbol_):] if s == symbol_ or is_pending(date_, s, start_time_, end_time_)]
+
+            else:
+
+                symbols = [symbol_]
+
+            batch_trades.update(fetch_trades(db_list_[0], date_, symbols, start_time_, end_time_))
+
+        queried_trades = batch_trades.pop((symbol_, date_))
+
+        return queried_trades, queried_trades is not None
+
+    # Create a function to write the checkpoint of the query of a symbol on a date
+
+    def checkpoint_query(date_, symbol_, queried_trades_, success_query_sql_):
+
+        if args_.checkpoint_dir is None or (symbol_, date_) in checkpoint_done:
+
+            return
+
+        if not success_query_sql_:
+
+            write_manifest_entry(args_.checkpoint_dir, symbol_, date_, 'query', 'failed', 0, shard_id)
+
+        else:
+
+            write_cache(queried_trades_, partition_path(args_.checkpoint_dir, 'query', symbol_, date_))
+            write_manifest_entry(args_.checkpoint_dir, symbol_, date_, 'query', 'ok' if queried_trades_.shape[0] > 0 else 'empty',
+                                 queried_trades_.shape[0], shard_id)
+            checkpoint_done.add((symbol_, date_))
+
+    # Create a function to run the SQL queries of all the symbols and dates concurrently over the pool of connections: the queries are
+    # written to the checkpoint as soon as each of them is completed
+
+    def prefetch_trades(dates_, start_time_, end_time_):
+
+        units = []
+
+        for date_ in dates_:
+
+            symbols = [s for s in symbol_list_ if is_pending(date_, s, start_time_, end_time_)]
+
+            if args_.batch_query and len(symbols) > 0:
+
+                units.append((date_, symbols))
+
+            else:
+
+                units.extend((date_, [s]) for s in symbols)
+
+        def run_unit(unit_):
+
+            db_ = db_pool.get()
+
+            try:
+
+                fetched_trades = fetch_trades(db_, unit_[0], unit_[1], start_time_, end_time_)
+
+            finally:
+
+                db_pool.put(db_)
+
+            with checkpoint_lock:
+
+                for (symbol_, date_), queried_trades_ in fetched_trades.items():
+
+                    if queried_trades_ is not None:
+
+                        checkpoint_query(date_, symbol_, queried_trades_, True)
+
+            return fetched_trades
+
+        print('Running {} queries over {} connections.'.format(len(units), args_.n_workers))
 
-def n_obs(queried_trades_, date_):
+        with ThreadPoolExecutor(max_workers=args_.n_workers) as executor:
 
-    global count_2, min_n_obs, min_n_obs_day, max_n_obs, max_n_obs_day
-    count_2 += 1
-    obs = queried_trades_.shape[0]
+            for fetched_trades in executor.map(run_unit, units):
 
-    if count_2 == 1:
+                batch_trades.update(fetched_trades)
 
-        min_n_obs = obs
-        n_obs_table.loc[count_1, 'min_n_obs'] = min_n_obs
-        n_obs_table.loc[count_1, 'min_n_obs_day'] = pd.to_datetime(date_).strftime('%Y-%m-%d')
+    # Create a function to apply the filter policy to the trades fetched with all their condition codes, and count the trades kept by each
+    # of the filter policies to compare them
 
-        max_n_obs = obs
-        n_obs_table.loc[count_1, 'max_n_obs'] = max_n_obs
-        n_obs_table.loc[count_1, 'max_n_obs_day'] = pd.to_datetime(date_).strftime('%Y-%m-%d')
+    def filter_conditions(queried_trades_, symbol_, date_):
 
-    elif obs < min_n_obs:
+        start_stage = time.time()
+        policy_counts[symbol_]['fetched'] += queried_trades_.shape[0]
 
-        min_n_obs = obs
-        n_obs_table.loc[count_1, 'min_n_obs'] = min_n_obs
-        n_obs_table.loc[count_1, 'min_n_obs_day'] = pd.to_datetime(date_).strftime('%Y-%m-%d')
+        for policy in filter_policies:
 
-    elif obs > max_n_obs:
+            policy_counts[symbol_][policy] += int(policy_mask(queried_trades_, filter_policies[policy]).sum())
 
-        max_n_obs = obs
-        n_obs_table.loc[count_1, 'max_n_obs'] = max_n_obs
-        n_obs_table.loc[count_1, 'max_n_obs_day'] = pd.to_datetime(date_).strftime('%Y-%m-%d')
+        keep = policy_mask(queried_trades_, filter_policies[args_.filter_policy])
+        filtered_trades = queried_trades_[keep].drop(columns='tr_scond_mask').reset_index(drop=True)
+        record_stage(metrics_, 'filter', symbol_, date_, start_stage, queried_trades_.shape[0], filtered_trades.shape[0])
 
+        return filtered_trades
 
-# Run the SQL queries and compute the min and max number of observations for each queried symbol
+    # Create a function to check the min and max number of observations for each symbol
 
-warning_queried_trades = []
-warning_query_sql = []
-warning_ctm_date = []
+    def n_obs(queried_trades_, date_):
 
-n_obs_table = pd.DataFrame({'symbol': [], 'min_n_obs': [], 'min_n_obs_day': [], 'max_n_obs': [], 'max_n_obs_day': []})
+        nonlocal count_2, min_n_obs, max_n_obs
+        count_2 += 1
+        obs = queried_trades_.shape[0]
 
-output = pd.DataFrame([])
+        if count_2 == 1:
 
-remove_dates = []
+            min_n_obs = obs
+            n_obs_table.loc[count_1, 'min_n_obs'] = min_n_obs
+            n_obs_table.loc[count_1, 'min_n_obs_day'] = pd.to_datetime(date_).strftime('%Y-%m-%d')
 
-for count_1, symbol in enumerate(symbol_list):
+            max_n_obs = obs
+            n_obs_table.loc[count_1, 'max_n_obs'] = max_n_obs
+            n_obs_table.loc[count_1, 'max_n_obs_day'] = pd.to_datetime(date_).strftime('%Y-%m-%d')
 
-    n_obs_table.loc[count_1, 'symbol'] = symbol
-    min_n_obs = None
-    min_n_obs_day = None
-    max_n_obs = None
-    max_n_obs_day = None
-    count_2 = 0
+        elif obs < min_n_obs:
 
-    for date in date_list:
+            min_n_obs = obs
+            n_obs_table.loc[count_1, 'min_n_obs'] = min_n_obs
+            n_obs_table.loc[count_1, 'min_n_obs_day'] = pd.to_datetime(date_).strftime('%Y-%m-%d')
 
-        print('Running a query with: symbol: {}, date: {}, start_time: {}; end_time: {}.'.format(symbol, pd.to_datetime(date).strftime('%Y-%m-%d'),
-              args.start_time, args.end_time))
+        elif obs > max_n_obs:
 
-        all_tables = db.list_tables(library='taqm_{}'.format(date[:4]))
+            max_n_obs = obs
+            n_obs_table.loc[count_1, 'max_n_obs'] = max_n_obs
+            n_obs_table.loc[count_1, 'max_n_obs_day'] = pd.to_datetime(date_).strftime('%Y-%m-%d')
 
-        if ('ctm_' + date) in all_tables:
+    # Run the SQL queries and compute the min and max number of observations for each queried symbol
 
-            queried_trades, success_query_sql = query_sql(date, symbol, args.start_time, args.end_time)
+    warning_queried_trades = []
+    warning_query_sql = []
+    warning_ctm_date = []
+
+    batch_trades = {}
+
+    checkpoint_done = set()
+    checkpoint_lock = threading.Lock()
+
+    # Bucket the trades pushed down to the database at the common divisor of the candidate frequencies and of the stored ones, so that the
+    # bars of every frequency can be built from whole buckets
+
+    freq_list_all = freq_list + sorted({dataset_params_[symbol]['freq'] for symbol in dataset_params_} - set(freq_list) - {None})
+    pushdown_freq = common_bucket(freq_list_all) if args_.pushdown == 'bars' else None
+
+    if args_.checkpoint_dir is not None:
+
+        run_settings = {'start_time': args_.start_time, 'end_time': args_.end_time, 'tr_corr_keep': tr_corr_keep, 'tr_scond_drop': tr_scond_drop}
+
+        if args_.fetch_conditions:
+
+            run_settings = {'start_time': args_.start_time, 'end_time': args_.end_time, 'fetch_conditions': True}
+
+        elif args_.pushdown != 'none':
+
+            run_settings['pushdown'] = [args_.pushdown, pushdown_freq]
+
+        run_settings['price_dtype'] = args_.price_dtype
+        check_checkpoint_run(args_.checkpoint_dir, run_settings)
+        checkpoint_done = read_manifest(args_.checkpoint_dir, 'query', ['ok', 'empty'])
+        print('Resuming from the checkpoint: {} queries have already been completed.'.format(len(checkpoint_done)))
+
+    # Select the queries of the shard run by this task: the merge step reads the queries of all the shards from the checkpoint
+
+    units_shard = None
+    shard_id = None
+
+    if args_.n_shards > 1 and not args_.merge:
+
+        units_shard = set(shard_units(symbol_list_, date_list_, args_.shard_id, args_.n_shards))
+        shard_id = args_.shard_id
+        print('Running the shard {} of {}: {} of the {} queries.'.format(shard_id, args_.n_shards, len(units_shard),
+              len(symbol_list_) * len(date_list_)))
+
+    missing_dates = {date for _, date in read_manifest(args_.checkpoint_dir, 'query', ['missing'])} if args_.merge else set()
+
+    for date in date_list_:
+
+        if args_.merge:
+
+            table_found = date not in missing_dates
+
+        else:
+
+            start_stage = time.time()
+            all_tables = list_tables_cached(db_list_[0], 'taqm_{}'.format(date[:4]), args_.catalog_dir, args_.catalog_expiry)
+            record_stage(metrics_, 'catalog', '', date, start_stage, 0, len(all_tables))
+            table_found = ('ctm_' + date) in all_tables
+
+        if not table_found:
+
+            print('*** WARNING: Could not find the table ctm_{} in the table list: the date has been removed from date_list; '
+                  'the warning has been recorded to "warning_ctm_date".'.format(date))
+            warning_ctm_date.append(date)
+
+            for symbol in symbol_list_:
+
+                if units_shard is not None and (symbol, date) in units_shard:
+
+                    write_manifest_entry(args_.checkpoint_dir, symbol, date, 'query', 'missing', 0, shard_id)
+
+    date_list = [d for d in date_list_ if d not in warning_ctm_date]
+
+    if len(date_list) == 0:
+
+        raise RuntimeError('Could not find any table in the table list.')
+
+    db_pool = queue.Queue()
+
+    for db_conn in db_list_:
+
+        db_pool.put(db_conn)
+
+    if args_.merge:
+
+        pending_units = [(symbol, date) for date in date_list for symbol in symbol_list_ if (symbol, date) not in checkpoint_done]
+
+        if len(pending_units) > 0:
+
+            raise RuntimeError('The shards did not complete {} queries, among which {}: run their shards again before the merge.'.format(
+                               len(pending_units), pending_units[:5]))
+
+    if args_.n_workers > 1:
+
+        prefetch_trades(date_list, args_.start_time, args_.end_time)
+
+    # Run the SQL queries of the shard and write them to the checkpoint: the dates are removed from date_list only in the merge step
+
+    if units_shard is not None:
+
+        for date in date_list:
+
+            for symbol in symbol_list_:
+
+                if (symbol, date) not in units_shard:
+
+                    continue
+
+                print('Running a query with: symbol: {}, date: {}, start_time: {}; end_time: {}.'.format(symbol,
+                      pd.to_datetime(date).strftime('%Y-%m-%d'), args_.start_time, args_.end_time))
+
+                queried_trades, success_query_sql = query_sql(date, symbol, args_.start_time, args_.end_time)
+                checkpoint_query(date, symbol, queried_trades, success_query_sql)
+
+                if not success_query_sql:
+
+                    print('*** WARNING: The warning has been recorded to "warning_query_sql".')
+                    warning_query_sql.append('{}+{}'.format(symbol, date))
+
+        section('Log of the warnings raised by the shard {} of {}'.format(shard_id, args_.n_shards))
+
+        print('*** LOG: warning_ctm_date:\n', warning_ctm_date)
+
+        print('*** LOG: warning_query_sql:\n', warning_query_sql)
+
+        return None, None, date_list
+
+    n_obs_table = pd.DataFrame({'symbol': [], 'min_n_obs': [], 'min_n_obs_day': [], 'max_n_obs': [], 'max_n_obs_day': []})
+
+    output_chunks = []
+
+    remove_dates = []
+
+    policy_counts = {symbol: dict.fromkeys(['fetched'] + list(filter_policies), 0) for symbol in symbol_list_}
+
+    for count_1, symbol in enumerate(symbol_list_):
+
+        n_obs_table.loc[count_1, 'symbol'] = symbol
+        min_n_obs = None
+        max_n_obs = None
+        count_2 = 0
+
+        for date in date_list:
+
+            print('Running a query with: symbol: {}, date: {}, start_time: {}; end_time: {}.'.format(symbol,
+                  pd.to_datetime(date).strftime('%Y-%m-%d'), args_.start_time, args_.end_time))
+
+            queried_trades, success_query_sql = query_sql(date, symbol, args_.start_time, args_.end_time)
+            checkpoint_query(date, symbol, queried_trades, success_query_sql)
+
+            if success_query_sql and args_.fetch_conditions:
+
+                queried_trades = filter_conditions(queried_trades, symbol, date)
 
             if success_query_sql:
 
                 if queried_trades.shape[0] > 0:
 
                     print('Appending the queried trades to the output.')
-                    output = output.append(queried_trades)
+                    output_chunks.append(compact_trades(queried_trades, args_.price_dtype))
                     n_obs(queried_trades, date)
 
                 else:
@@ -312,48 +898,67 @@ for count_1, symbol in enumerate(symbol_list):
                 print('*** WARNING: The warning has been recorded to "warning_query_sql".')
                 warning_query_sql.append('{}+{}'.format(symbol, date))
 
-        else:
+        date_list = [d for d in date_list if d not in list(set(remove_dates))]
 
-            print('*** WARNING: Could not find the table ctm_{} in the table list: the date has been removed from date_list; '
-                  'the warning has been recorded to "warning_ctm_date".'.format(date))
-            remove_dates.append(date)
-            warning_ctm_date.append(date)
+        if len(date_list) == 0:
 
-    date_list = [d for d in date_list if d not in list(set(remove_dates))]
+            raise RuntimeError('At least one symbol did not trade for each date.')
 
-    if len(date_list) == 0:
+    batch_trades.clear()
+
+    output = concat_trades(output_chunks)
+    del output_chunks
+
+    output = output[pd.to_datetime(output['date']).isin([pd.to_datetime(d) for d in date_list])]
+
+    # Index the partitions of each symbol and date
+
+    output, output_index = partition_index(output)
 
-        print('\n*** ERROR: Could not find any table in the table list or at least one symbol did not trade for each date.')
-        exit()
+    print('\nThe updated parameters are: symbol_list: {}; date_list: {}'.format(symbol_list_, date_list))
 
-output = output[pd.to_datetime(output['date']).isin([pd.to_datetime(d) for d in date_list])]
+    if warnings_ is not None:
 
-print('\nThe updated parameters are: symbol_list: {}; date_list: {}'.format(args.symbol_list, date_list))
+        warnings_.update({'warning_queried_trades': warning_queried_trades, 'warning_ctm_date': warning_ctm_date,
+                          'warning_query_sql': warning_query_sql})
 
+    # Display the log of the warnings
 
-# Display the log of the warnings
+    section('Log of the raised warnings')
 
-section('Log of the raised warnings')
+    print('*** LOG: warning_queried_trades:\n', warning_queried_trades)
 
-print('*** LOG: warning_queried_trades:\n', warning_queried_trades)
+    print('*** LOG: warning_ctm_date:\n', warning_ctm_date)
 
-print('*** LOG: warning_ctm_date:\n', warning_ctm_date)
+    print('*** LOG: warning_query_sql:\n', warning_query_sql)
 
-print('*** LOG: warning_query_sql:\n', warning_query_sql)
+    # Display the dataframe with the min and max number of observations for each symbol
 
+    section('Min and max number of observations for each queried symbol')
 
-# Display the dataframe with the min and max number of observations for each symbol
+    print(n_obs_table)
 
-section('Min and max number of observations for each queried symbol')
+    # Display the number of trades kept by each filter policy for each symbol
 
-print(n_obs_table)
+    if args_.fetch_conditions:
 
+        section('Number of trades kept by each filter policy: {} applied'.format(args_.filter_policy))
 
-# Display the dataframe of the queried trades
+        print(pd.DataFrame.from_dict(policy_counts, orient='index'))
 
-section('Queried data')
+    # Display the memory footprint of the queried trades
 
-print_output(output_=output, print_output_flag_=args.print_output, head_flag_=True)
+    section('Memory footprint of the queried data')
+
+    print(memory_footprint(output))
+
+    # Display the dataframe of the queried trades
+
+    section('Queried data')
+
+    print_output(output_=output, print_output_flag_=args_.print_output, head_flag_=True)
+
+    return output, output_index, date_list
 
 
 # ------------------------------------------------------------------------------------------------------------------------------------------
@@ -363,17 +968,18 @@ print_output(output_=output, print_output_flag_=args.print_output, head_flag_=Tr
 
 # Clean the data from unwanted 'tr_corr' and 'tr_scond'
 
-""" During the querying step, the data was already filtered for 'tr_corr' and 'tr_scond':
+""" During the querying step, the data was already filtered for 'tr_corr' and 'tr_scond', by the SQL query or, with -fk, locally by the
+    selected filter policy of 'filter_policies'. With the 'default' policy:
 
     - Observations with 'tr_corr' == '00' were kept
 
-    - Observations with 'tr_scond' in {'@', 'A', 'B', 'C', 'D', 'E', 'F', 'H', 'I', 'K', 'M', 
+    - Observations with 'tr_scond' in {'@', 'A', 'B', 'C', 'D', 'E', 'F', 'H', 'I', 'K', 'M',
       'N', 'O', 'Q', 'R', 'S', 'V', 'W', 'Y', '1', '4', '5', '6', '7', '8', '9'} were kept.
     - Observations with 'tr_scond' in {'G', 'L', 'P', 'T', 'U', 'X', 'Z'} were discarded.
 """
 
 
-# Clean the data from outliers
+# Define the candidate parameters to clean the data from outliers
 
 delta = 0.1
 
@@ -382,91 +988,72 @@ y_list = np.arange(0.02, 0.08, 0.02)
 k_grid, y_grid = np.meshgrid(k_list, y_list)
 ky_array = np.array([k_grid.ravel(), y_grid.ravel()]).T
 
-outlier_frame = pd.DataFrame(columns=['symbol', 'out_num', 'k', 'y'])
-outlier_frame['symbol'] = pd.Series(symbol_list)
-
-not_outlier_series = pd.Series([])
 
-for pos, symbol in enumerate(symbol_list):
+# Create a function to clean the data from outliers with the optimal, or the stored, (k, y) of each symbol
 
-    count = 0
+def clean_trades(args_, output_, output_index_, symbol_list_, date_list_, dataset_params_, metrics_):
 
-    for k, y in ky_array:
+    outlier_frame = pd.DataFrame(columns=['symbol', 'out_num', 'k', 'y'])
+    outlier_frame['symbol'] = pd.Series(symbol_list_)
 
-        count += 1
-        outlier_num_sym = 0
-        not_outlier_sym = pd.Series([])
+    position_days = []
+    price_days = []
 
-        perc_b = int(k * delta)
-        perc_t = int(k * (1 - delta) + 1)
+    for symbol in symbol_list_:
 
-        for date in date_list:
+        position_sym = [partition_slice(output_index_, symbol, date) for date in date_list_]
+        position_days.append(position_sym)
+        price_days.append([output_['price'].values[position_sym_day] for position_sym_day in position_sym])
 
-            price_sym_day = output.loc[(output['sym_root'] == symbol) & (pd.to_datetime(output['date']) == pd.to_datetime(date)), 'price']
+    start_stage = time.time()
 
-            center_beg = int((k - 1) / 2)
-            center_end = int(len(price_sym_day)) - center_beg
+    ky_array_sym = [np.array([[dataset_params_[symbol]['k'], dataset_params_[symbol]['y']]]) if symbol in dataset_params_ else ky_array
+                    for symbol in symbol_list_]
 
-            window = np.sort(price_sym_day[:int(k)])
-            mean_rolling = np.repeat(np.nan, len(price_sym_day))
-            std_rolling = np.repeat(np.nan, len(price_sym_day))
+    if args_.n_processes > 1:
 
-            for i in range(center_beg, center_end):
+        with ProcessPoolExecutor(max_workers=args_.n_processes) as executor:
 
-                mean_rolling[i] = window[perc_b:perc_t].mean()
-                std_rolling[i] = window[perc_b:perc_t].std()
+            outlier_results = list(executor.map(filter_outliers_timed, price_days, ky_array_sym, repeat(delta)))
 
-                if i < center_end - 1:
+    else:
 
-                    idx_drop = np.searchsorted(window, price_sym_day[i - center_beg])
-                    window[idx_drop] = price_sym_day[i + center_beg + 1]
-                    window.sort()
+        outlier_results = [filter_outliers_timed(price_sym, ky_array_s, delta) for price_sym, ky_array_s in zip(price_days, ky_array_sym)]
 
-            price_sym_day_mean = pd.Series(mean_rolling, index=price_sym_day.index)
-            price_sym_day_std = pd.Series(std_rolling, index=price_sym_day.index)
+    not_outlier = np.zeros(len(output_), dtype=bool)
 
-            price_sym_day_mean.iloc[:center_beg] = price_sym_day_mean.iloc[center_beg]
-            price_sym_day_mean.iloc[center_end:] = price_sym_day_mean.iloc[center_end - 1]
-            price_sym_day_std.iloc[:center_beg] = price_sym_day_std.iloc[center_beg]
-            price_sym_day_std.iloc[center_end:] = price_sym_day_std.iloc[center_end - 1]
+    for pos, (outlier_num_sym, k, y, not_outlier_sym, clean_time) in enumerate(outlier_results):
 
-            left_con = (price_sym_day - price_sym_day_mean).abs()
-            right_con = (3 * price_sym_day_std) + y
+        outlier_frame.loc[pos, 'out_num'] = outlier_num_sym
+        outlier_frame.loc[pos, 'k'] = k
+        outlier_frame.loc[pos, 'y'] = y
 
-            outlier_num_sym += (left_con > right_con).sum()
-            not_outlier_sym = not_outlier_sym.append(left_con < right_con)
+        record_stage(metrics_, 'clean', symbol_list_[pos], '', time.time() - clean_time, sum(len(price_day) for price_day in price_days[pos]),
+                     sum(not_outlier_day.sum() for not_outlier_day in not_outlier_sym))
 
-        if count == 1:
+        for position_sym_day, not_outlier_sym_day in zip(position_days[pos], not_outlier_sym):
 
-            outlier_frame.loc[pos, 'out_num'] = outlier_num_sym
-            outlier_frame.loc[pos, 'k'] = k
-            outlier_frame.loc[pos, 'y'] = y
-            not_outlier_sym_f = not_outlier_sym
+            not_outlier[position_sym_day] = not_outlier_sym_day
 
-        elif outlier_num_sym < outlier_frame.loc[pos, 'out_num']:  # >
+    not_outlier_series = pd.Series(not_outlier, index=output_.index)
 
-            outlier_frame.loc[pos, 'out_num'] = outlier_num_sym
-            outlier_frame.loc[pos, 'k'] = k
-            outlier_frame.loc[pos, 'y'] = y
-            not_outlier_sym_f = not_outlier_sym
+    record_stage(metrics_, 'outlier_filter', '', '', start_stage, len(output_), not_outlier.sum())
 
-    not_outlier_series = not_outlier_series.append(not_outlier_sym_f)
+    output_filtered = output_[not_outlier_series]
 
-output_filtered = output[not_outlier_series]
+    # Display the table of optimal k, y
 
+    section('k, y to optimally filter each queried symbol')
 
-# Display the table of optimal k, y
+    print(outlier_frame)
 
-section('k, y to optimally filter each queried symbol')
+    # Display the cleaned dataframe of the queried trades
 
-print(outlier_frame)
+    section('Cleaned data')
 
+    print_output(output_=output_filtered, print_output_flag_=args_.print_output, head_flag_=True)
 
-# Display the cleaned dataframe of the queried trades
-
-section('Cleaned data')
-
-print_output(output_=output_filtered, print_output_flag_=args.print_output, head_flag_=True)
+    return output_filtered, not_outlier, outlier_frame
 
 
 # ------------------------------------------------------------------------------------------------------------------------------------------
@@ -474,110 +1061,173 @@ print_output(output_=output_filtered, print_output_flag_=args.print_output, head
 # ------------------------------------------------------------------------------------------------------------------------------------------
 
 
-# Create a function to aggregate simultaneous observations
+# Create a function to aggregate simultaneous observations, summing their counts if the database has already aggregated them
+
+def aggregate_trades(args_, output_filtered_, metrics_):
+
+    start_stage = time.time()
+
+    price_median = output_filtered_.groupby(['sym_root', 'date', 'time_m'], observed=True)['price'].median()
+    volume_sum = output_filtered_.groupby(['sym_root', 'date', 'time_m'], observed=True)['size'].sum()
+    if 'count' in output_filtered_:
+
+        trade_count = output_filtered_.groupby(['sym_root', 'date', 'time_m'], observed=True)['count'].sum()
 
-price_median = output_filtered.groupby(['sym_root', 'date', 'time_m']).median().reset_index().loc[:, ['sym_root', 'date', 'time_m', 'price']]
-volume_sum = output_filtered.groupby(['sym_root', 'date', 'time_m']).sum().reset_index().loc[:, 'size']
-output_aggregate = pd.concat([price_median, volume_sum], axis=1)
+    else:
 
+        trade_count = output_filtered_.groupby(['sym_root', 'date', 'time_m'], observed=True)['size'].count().rename('count')
+    output_aggregate = pd.concat([price_median, volume_sum, trade_count], axis=1).reset_index()
+    output_aggregate, output_aggregate_index = partition_index(output_aggregate)
 
-# Display the aggregated dataframe of the queried trades
+    record_stage(metrics_, 'aggregation', '', '', start_stage, len(output_filtered_), len(output_aggregate))
 
-section('Aggregated data')
+    # Display the aggregated dataframe of the queried trades
 
-print_output(output_=output_aggregate, print_output_flag_=args.print_output, head_flag_=True)
+    section('Aggregated data')
 
+    print_output(output_=output_aggregate, print_output_flag_=args_.print_output, head_flag_=True)
 
-# Create a function to resample observations at lower frequency
+    return output_aggregate, output_aggregate_index
+
+
+# Define the candidate frequencies to resample the observations
 
 freq_list = ['5S']
 
 """ ALTERNATIVE IMPLEMENTATION
     --------------------------
-    You can test different frequencies using: freq_list = ['500L', '1S', '2S', '5S'] 
+    You can test different frequencies using: freq_list = ['500L', '1S', '2S', '5S']
 """
 
-nan_frame = pd.DataFrame(columns=['symbol', 'freq', 'ratio'])
-nan_frame['symbol'] = pd.Series(symbol_list)
 
-for count, freq in enumerate(freq_list):
+# Create a function to resample observations at lower frequency, with the optimal, or the stored, frequency of each symbol
 
-    output_resampled = pd.DataFrame(columns=output_aggregate.columns)
+def resample_trades(args_, output_aggregate_, output_aggregate_index_, symbol_list_, date_list_, dataset_params_, metrics_):
 
-    for pos, symbol in enumerate(symbol_list):
+    nan_frame = pd.DataFrame(columns=['symbol', 'freq', 'ratio'])
+    nan_frame['symbol'] = pd.Series(symbol_list_)
 
-        num_nan_sym = 0
-        num_tot_sym = 0
+    freq_list_all = freq_list + sorted({dataset_params_[symbol]['freq'] for symbol in dataset_params_} - set(freq_list) - {None})
 
-        for date in date_list:
+    num_nan, num_tot = count_empty_buckets(output_aggregate_, output_aggregate_index_, symbol_list_, date_list_, args_.start_time,
+                                           args_.end_time, freq_list_all)
+
+    for pos, symbol in enumerate(symbol_list_):
+
+        freq_list_sym = [dataset_params_[symbol]['freq']] if dataset_params_.get(symbol, {}).get('freq') is not None else freq_list
+
+        for freq in freq_list_sym:
+
+            count = freq_list_all.index(freq)
+            ratio = num_nan[pos, count] / num_tot[pos, count]
+
+            if freq == freq_list_sym[0] or ratio < nan_frame.loc[pos, 'ratio']:
+
+                nan_frame.loc[pos, 'freq'] = freq
+                nan_frame.loc[pos, 'ratio'] = ratio
+
+    output_resampled_sym = {}
+
+    for freq in freq_list_all:
+
+        symbol_list_freq = [symbol for pos, symbol in enumerate(symbol_list_) if nan_frame.loc[pos, 'freq'] == freq]
+
+        if len(symbol_list_freq) == 0:
 
-            df_sym_day = output_aggregate[(output_aggregate['sym_root'] == symbol) & (pd.to_datetime(output_aggregate['date']) == pd.to_datetime(date))]
-            index_resample = pd.DatetimeIndex(df_sym_day['date'].apply(str) + ' ' + df_sym_day['time_m'].apply(str))
-            df_sym_day = df_sym_day.set_index(index_resample)
-            price_last = df_sym_day.resample(freq, label='right', closed='right').last().loc[:, ['sym_root', 'date', 'time_m', 'price']]
-            volume_sum = df_sym_day.resample(freq, label='right', closed='right').sum().loc[:, 'size']
-            df_sym_day_resampled = pd.concat([price_last, volume_sum], axis=1)
+            continue
 
-            start_datetime = pd.to_datetime(date).strftime('%Y-%m-%d') + ' ' + args.start_time
-            end_datetime = pd.to_datetime(date).strftime('%Y-%m-%d') + ' ' + args.end_time
-            index_extended = pd.date_range(start=start_datetime, end=end_datetime, freq=freq)
-            df_extended_index = pd.DataFrame(index=index_extended)
-            df_resampled = df_extended_index.join(df_sym_day_resampled)
+        start_stage = time.time()
+        output_resampled = build_bars(output_aggregate_, output_aggregate_index_, symbol_list_freq, date_list_, args_.start_time, args_.end_time,
+                                      freq)
+        record_stage(metrics_, 'resample_' + freq, ' '.join(symbol_list_freq), '', start_stage,
+                     sum(offset[1] - offset[0] for key, offset in output_aggregate_index_.items() if key[0] in symbol_list_freq),
+                     len(output_resampled))
+        num_grid = len(output_resampled) // (len(symbol_list_freq) * len(date_list_))
 
-            num_nan_sym += pd.isna(df_resampled['sym_root']).sum()
-            num_tot_sym += len(df_resampled)
+        for pos_sym, symbol in enumerate(symbol_list_freq):
 
-            # The position of this line is crucial
-            df_resampled['price'] = df_resampled['price'].interpolate(method='linear')
-            df_resampled['price'] = df_resampled['price'].fillna(method='bfill')
-            df_resampled['size'] = df_resampled['size'].fillna(method='bfill')
-            df_resampled['sym_root'] = symbol
-            df_resampled['date'] = df_resampled.index.date
-            df_resampled['time_m'] = df_resampled.index.time
+            output_resampled_sym[symbol] = output_resampled.iloc[pos_sym * len(date_list_) * num_grid:(pos_sym + 1) * len(date_list_) * num_grid]
 
-            output_resampled = output_resampled.append(df_resampled)
+    output_resampled_f = pd.concat([output_resampled_sym[symbol] for symbol in symbol_list_])
 
-        ratio = num_nan_sym / num_tot_sym
+    output_resampled_f, output_resampled_index = partition_index(output_resampled_f)
 
-        if count == 0:
+    # Display the table of optimal resampling frequencies
 
-            nan_frame.loc[pos, 'freq'] = freq
-            nan_frame.loc[pos, 'ratio'] = ratio
-            output_resampled_f = output_resampled
+    section('Resampling frequencies')
 
-        elif ratio < nan_frame.loc[pos, 'ratio']:
+    print(nan_frame)
 
-            nan_frame.loc[pos, 'freq'] = freq
-            nan_frame.loc[pos, 'ratio'] = ratio
-            output_resampled_f = output_resampled
+    # Display the resampled dataframe of the queried trades
 
+    section('Resampled data')
 
-# Display the table of optimal resampling frequencies
+    print_output(output_=output_resampled_f, print_output_flag_=args_.print_output, head_flag_=True)
 
-section('Resampling frequencies')
+    return output_resampled_f, output_resampled_index, nan_frame
 
-print(nan_frame)
 
+# Create a function to build tick, volume or dollar bars of the aggregated trades instead of resampling them on a clock: the bars contain
+# only observed trades, so the ratio of filled observations of each symbol is zero
 
-# Display the resampled dataframe of the queried trades
+def build_event_trades(args_, output_aggregate_, output_aggregate_index_, symbol_list_, date_list_, metrics_):
 
-section('Resampled data')
+    nan_frame = pd.DataFrame({'symbol': symbol_list_, 'freq': None, 'ratio': 0.0})
 
-print_output(output_=output_resampled_f, print_output_flag_=args.print_output, head_flag_=True)
+    start_stage = time.time()
+    output_bars = build_event_bars(output_aggregate_, output_aggregate_index_, symbol_list_, date_list_, args_.bar_type, args_.bar_size)
+    record_stage(metrics_, 'bars_' + args_.bar_type, ' '.join(symbol_list_), '', start_stage, len(output_aggregate_), len(output_bars))
 
+    output_bars, output_bars_index = partition_index(output_bars)
 
-# Display the final plots of the queried trades
+    # Display the number of bars of each symbol
 
-if args.graph_output:
+    section('Number of {} bars of size {}'.format(args_.bar_type, args_.bar_size))
 
-    graph_output(output_=output_resampled_f, symbol_list_=symbol_list, date_index_=date_index, usage_='Final')
+    bars_frame = pd.DataFrame({'symbol': symbol_list_, 'n_bars': [len(output_bars.iloc[partition_slice(output_bars_index, symbol)])
+                                                                  for symbol in symbol_list_]})
+    bars_frame['n_bars_day'] = bars_frame['n_bars'] / len(date_list_)
 
+    print(bars_frame)
 
-# Display the comparative plot between the original and the final plots
+    # Display the dataframe of the bars
 
-if args.graph_output:
+    section('{} bars'.format(args_.bar_type.capitalize()))
 
-    graph_comparison(output, output_resampled_f, symbol_list[0], date_list[0], 'Original', 'Final')
+    print_output(output_=output_bars, print_output_flag_=args_.print_output, head_flag_=True)
+
+    return output_bars, output_bars_index, nan_frame
+
+
+# Create a function to display the final plots and the comparative plot between the original and the final plots: with more than one
+# graph process, the plots are rendered in parallel with the Agg backend and only saved
+
+def plot_trades(args_, output_, output_index_, output_resampled_f_, output_resampled_index_, symbol_list_, date_index_, date_list_, metrics_):
+
+    start_stage = time.time()
+
+    if args_.graph_processes > 1:
+
+        with ProcessPoolExecutor(max_workers=args_.graph_processes, initializer=graph_backend_agg) as executor:
+
+            futures = [graph_output(output_resampled_f_, symbol_list_, date_index_, 'Final', output_resampled_index_, args_.graph_decimate,
+                                    executor),
+                       graph_comparison(output_, output_resampled_f_, symbol_list_[0], date_list_[0], 'Original', 'Final', output_index_,
+                                        output_resampled_index_, args_.graph_decimate, executor)]
+
+            for future in futures:
+
+                future.result()
+
+    else:
+
+        graph_output(output_=output_resampled_f_, symbol_list_=symbol_list_, date_index_=date_index_, usage_='Final',
+                     index_=output_resampled_index_, decimate_=args_.graph_decimate)
+
+        graph_comparison(output_, output_resampled_f_, symbol_list_[0], date_list_[0], 'Original', 'Final', output_index_,
+                         output_resampled_index_, decimate_=args_.graph_decimate)
+
+    record_stage(metrics_, 'plot', '', '', start_stage, len(output_resampled_f_), 0)
 
 
 # ------------------------------------------------------------------------------------------------------------------------------------------
@@ -585,49 +1235,172 @@ if args.graph_output:
 # ------------------------------------------------------------------------------------------------------------------------------------------
 
 
-# Save the time series of prices
+# Create a function to save the time series of prices, the parameters used to clean and resample them, and the realized measures of the
+# bars and of the days
+
+def export_datasets(args_, output_resampled_f_, output_resampled_index_, symbol_list_, outlier_frame_, nan_frame_, metrics_):
+
+    for pos, symbol in enumerate(symbol_list_):
+
+        start_stage = time.time()
+        data = pd.DataFrame(output_resampled_f_.iloc[partition_slice(output_resampled_index_, symbol)][['date', 'time_m', 'price', 'size']])
+        data['price'] = data['price'].astype(args_.price_dtype)
+        write_dataset(data, os.path.join(dataset_root(args_), symbol), args_.output_format, args_.append)
+        write_dataset_params(os.path.join(dataset_root(args_), symbol), {'start_time': args_.start_time, 'end_time': args_.end_time,
+                             'k': int(outlier_frame_.loc[pos, 'k']), 'y': float(outlier_frame_.loc[pos, 'y']),
+                             'freq': nan_frame_.loc[pos, 'freq'], 'bar_type': args_.bar_type, 'bar_size': args_.bar_size,
+                             'filter_policy': args_.filter_policy})
+        record_stage(metrics_, 'export', symbol, '', start_stage, len(data), len(data))
+
+        start_stage = time.time()
+        features, features_day = realized_features(output_resampled_f_.iloc[partition_slice(output_resampled_index_, symbol)], args_.end_time)
+        write_dataset(features, os.path.join(dataset_root(args_), symbol), args_.output_format, args_.append, 'features')
+        write_dataset(features_day, os.path.join(dataset_root(args_), symbol), args_.output_format, args_.append, 'features_day')
+        record_stage(metrics_, 'features', symbol, '', start_stage, len(data), len(features) + len(features_day))
+
+
+# Create a function to save the catalog of the symbol-days of the extraction: the status, the number of trades, outliers and bars, the ratio
+# of filled bars, the parameters and the fetch and clean times of each symbol-day, with the symbol-days removed by the warnings
+
+def export_catalog(args_, output_index_, not_outlier_, output_resampled_f_, output_resampled_index_, symbol_list_, date_list_all_, date_list_,
+                   outlier_frame_, nan_frame_, warnings_, metrics_):
+
+    start_stage = time.time()
+
+    fetch_time = {}
+    clean_time = {}
+
+    for metric in metrics_:
+
+        if metric['stage'] == 'fetch':
+
+            fetch_time.update({(symbol, metric['date'].replace('-', '')): metric['wall_time'] for symbol in metric['symbol'].split(' ')})
+
+        elif metric['stage'] == 'clean':
+
+            clean_time[metric['symbol']] = metric['wall_time']
+
+    unit_status = {(symbol, date): 'no_table' for date in warnings_.get('warning_ctm_date', []) for symbol in symbol_list_}
+    unit_status.update({tuple(unit.split('+')): 'no_trades' for unit in warnings_.get('warning_queried_trades', [])})
+    unit_status.update({tuple(unit.split('+')): 'query_failed' for unit in warnings_.get('warning_query_sql', [])})
+
+    catalog = []
+
+    for pos, symbol in enumerate(symbol_list_):
+
+        for date in date_list_all_:
+
+            row = {'symbol': symbol, 'date': '{}-{}-{}'.format(date[:4], date[4:6], date[6:]),
+                   'status': unit_status.get((symbol, date), 'removed'), 'n_trades': 0, 'n_outliers': 0, 'n_bars': 0, 'nan_ratio': np.nan,
+                   'k': np.nan, 'y': np.nan, 'freq': None, 'bar_type': args_.bar_type, 'bar_size': args_.bar_size,
+                   'filter_policy': args_.filter_policy, 'start_time': args_.start_time, 'end_time': args_.end_time,
+                   'fetch_time': fetch_time.get((symbol, date), np.nan), 'clean_time': np.nan}
+
+            if date in date_list_:
+
+                position = partition_slice(output_index_, symbol, date)
+                bars = output_resampled_f_.iloc[partition_slice(output_resampled_index_, symbol, date)]
+
+                row.update({'status': 'ok', 'n_trades': position.stop - position.start, 'n_outliers': int((~not_outlier_[position]).sum()),
+                            'n_bars': len(bars), 'nan_ratio': float((bars['count'] == 0).mean()), 'k': outlier_frame_.loc[pos, 'k'],
+                            'y': outlier_frame_.loc[pos, 'y'], 'freq': nan_frame_.loc[pos, 'freq'],
+                            'clean_time': clean_time.get(symbol, np.nan)})
+
+            catalog.append(row)
+
+    catalog = pd.DataFrame(catalog)
+    write_catalog(catalog, dataset_root(args_))
+    record_stage(metrics_, 'catalog_export', '', '', start_stage, len(catalog), len(catalog))
+
+    # Display the number of symbol-days of the catalog by status
+
+    section('Catalog of the extracted symbol-days')
+
+    print(catalog.groupby(['symbol', 'status']).size().unstack(fill_value=0))
+
+
+# Create a function to stream the quotes of a symbol on a date and join them to its trades sorted by time
+
+def join_quotes(args_, db_, date_, symbol_, suffix_query_, trade_times_):
+
+    for attempt in range(args_.max_attempts):
+
+        try:
+
+            quote_chunks = db_.raw_sql(write_quote_query(date_, symbol_, suffix_query_, args_.end_time), chunksize=args_.quote_chunksize,
+                                       return_iter=True)
+            bid, ask = asof_join_quotes(trade_times_, quote_chunks)
+
+        except Exception:
+
+            rollback_query(db_)
+
+            if attempt < args_.max_attempts - 1:
 
-if not os.path.isdir('data'):
+                wait = args_.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                print('\n*** WARNING: The query failed: trying again in {:.1f} seconds.'.format(wait))
+                time.sleep(wait)
 
-    os.mkdir('data')
+            else:
+
+                print('\n*** WARNING: The query failed and the max number of attempts has been reached.')
+
+        else:
+
+            return bid, ask, True
+
+    return None, None, False
 
-if args.debug:
 
-    if not os.path.isdir('data/mode bg'):
+# Create a function to save the cleaned trades joined to the prevailing quotes, with the mid, the spread and the sign of each trade
 
-        os.mkdir('data/mode bg')
+def export_trades_quotes(args_, db_, output_, output_index_, not_outlier_, symbol_list_, suffix_query_, date_list_, metrics_):
 
-    if not os.path.isdir('data/mode bg/datasets'):
+    warning_quote_sql = []
+    warning_nbbo_date = []
 
-        os.mkdir('data/mode bg/datasets')
+    for date in date_list_:
 
-    for symbol in symbol_list:
+        if ('complete_nbbo_' + date) not in list_tables_cached(db_, 'taqm_{}'.format(date[:4]), args_.catalog_dir, args_.catalog_expiry):
 
-        if not os.path.isdir('data/mode bg/datasets/' + symbol):
+            print('*** WARNING: Could not find the table complete_nbbo_{} in the table list: the quotes of the date have not been joined; '
+                  'the warning has been recorded to "warning_nbbo_date".'.format(date))
+            warning_nbbo_date.append(date)
+            continue
 
-            os.mkdir('data/mode bg/datasets/' + symbol)
+        for symbol in symbol_list_:
 
-        data = pd.DataFrame(output_resampled_f[output_resampled_f['sym_root'] == symbol][['date', 'time_m', 'price', 'size']])
-        data.to_csv('data/mode bg/datasets/' + symbol + '/data.csv', index=False)
+            print('Joining the quotes with: symbol: {}, date: {}.'.format(symbol, pd.to_datetime(date).strftime('%Y-%m-%d')))
+            start_stage = time.time()
 
-else:
+            position = partition_slice(output_index_, symbol, date)
+            trades = output_.iloc[position][not_outlier_[position]]
+            trades = trades.iloc[np.argsort(trades['time_m'].values, kind='mergesort')]
+            trade_times = trades['time_m'].values
 
-    if not os.path.isdir('data/mode sl'):
+            bid, ask, success_quote_sql = join_quotes(args_, db_, date, symbol, suffix_query_, trade_times)
 
-        os.mkdir('data/mode sl')
+            if not success_quote_sql:
 
-    if not os.path.isdir('data/mode sl/datasets'):
+                print('*** WARNING: The warning has been recorded to "warning_quote_sql".')
+                warning_quote_sql.append('{}+{}'.format(symbol, date))
+                continue
 
-        os.mkdir('data/mode sl/datasets')
+            price = trades['price'].values.astype('float64')
+            mid = (bid + ask) / 2
 
-    for symbol in symbol_list:
+            trades_quotes = pd.DataFrame({'timestamp': trades['date'].values + trade_times.astype('timedelta64[ns]'),
+                                          'price': price.astype(args_.price_dtype),
+                                          'size': trades['size'].values, 'bid': bid, 'ask': ask, 'mid': mid, 'spread': ask - bid,
+                                          'sign': trade_signs(price, mid)})
+            write_trades_quotes(trades_quotes, os.path.join(dataset_root(args_), symbol), date)
+            record_stage(metrics_, 'quotes', symbol, date, start_stage, len(trades), len(trades_quotes))
 
-        if not os.path.isdir('data/mode sl/datasets/' + symbol):
+    section('Log of the warnings raised joining the quotes')
 
-            os.mkdir('data/mode sl/datasets/' + symbol)
+    print('*** LOG: warning_nbbo_date:\n', warning_nbbo_date)
 
-        data = pd.DataFrame(output_resampled_f[output_resampled_f['sym_root'] == symbol][['date', 'time_m', 'price', 'size']])
-        data.to_csv('data/mode sl/datasets/' + symbol + '/data.csv', index=False)
+    print('*** LOG: warning_quote_sql:\n', warning_quote_sql)
 
 
 # ------------------------------------------------------------------------------------------------------------------------------------------
@@ -635,18 +1408,126 @@ else:
 # ------------------------------------------------------------------------------------------------------------------------------------------
 
 
-# Close the connection to the wrds cloud
+# Create a function to run the stages of the extraction from the command line: the invalid settings and the failed stages raise errors,
+# which are printed before exiting
+
+def main(argv_=None):
+
+    # Set the displayed size of pandas objects
+
+    pd.set_option('display.max_rows', None)
+    pd.set_option('display.max_columns', None)
+    pd.set_option('display.width', None)
+
+    # Start timing the execution and create the list of the metrics of each stage
+
+    start = time.time()
+    stage_metrics = []
+
+    args = parse_args(argv_)
+
+    if args.debug:
+
+        section('You are debugging with: symbol_list: {} | start_date: {} | end_date: {} | start_time: {} | end_time: {}'.format(
+                args.symbol_list, args.start_date, args.end_date, args.start_time, args.end_time))
+
+    else:
+
+        section('You are querying with: symbol_list: {} | start_date: {} | end_date: {} | start_time: {} | end_time: {}'.format(
+                args.symbol_list, args.start_date, args.end_date, args.start_time, args.end_time))
+
+    check_libraries(args)
+
+    try:
+
+        check_shards(args)
+
+        symbol_list, suffix_query, date_index, date_list = check_input(args, stage_metrics)
+        date_index, date_list, dataset_params = select_new_dates(args, symbol_list, date_index, date_list)
+
+    except ValueError as error:
+
+        print('\n*** ERROR: {}'.format(error))
+        sys.exit(1)
+
+    if len(date_list) == 0:
+
+        print('\nThe datasets are already up to date: there are no new dates to extract.')
+        return
+
+    db_list = open_db_pool(args) if not args.merge or args.quotes else []
+
+    date_list_all = date_list
+    extract_warnings = {}
+
+    try:
+
+        output, output_index, date_list = extract_trades(args, db_list, symbol_list, suffix_query, date_list, dataset_params,
+                                                         stage_metrics, extract_warnings)
+
+    except (ValueError, RuntimeError) as error:
+
+        print('\n*** ERROR: {}'.format(error))
+        sys.exit(1)
+
+    if output is None:
+
+        print('\nThe shard {} of {} has been extracted: run the merge step with -mg once all the shards have been extracted.'.format(
+              args.shard_id, args.n_shards))
+
+    else:
+
+        output_filtered, not_outlier, outlier_frame = clean_trades(args, output, output_index, symbol_list, date_list, dataset_params,
+                                                                   stage_metrics)
+        output_aggregate, output_aggregate_index = aggregate_trades(args, output_filtered, stage_metrics)
+
+        if args.bar_type == 'time':
+
+            output_resampled_f, output_resampled_index, nan_frame = resample_trades(args, output_aggregate, output_aggregate_index,
+                                                                                    symbol_list, date_list, dataset_params, stage_metrics)
+
+        else:
+
+            output_resampled_f, output_resampled_index, nan_frame = build_event_trades(args, output_aggregate, output_aggregate_index,
+                                                                                       symbol_list, date_list, stage_metrics)
+
+        if args.graph_output:
+
+            plot_trades(args, output, output_index, output_resampled_f, output_resampled_index, symbol_list, date_index, date_list,
+                        stage_metrics)
+
+        export_datasets(args, output_resampled_f, output_resampled_index, symbol_list, outlier_frame, nan_frame, stage_metrics)
+        export_catalog(args, output_index, not_outlier, output_resampled_f, output_resampled_index, symbol_list, date_list_all, date_list,
+                       outlier_frame, nan_frame, extract_warnings, stage_metrics)
+
+        if args.quotes:
+
+            export_trades_quotes(args, db_list[0], output, output_index, not_outlier, symbol_list, suffix_query, date_list, stage_metrics)
+
+    # Close the connections to the wrds cloud
+
+    for db_conn in db_list:
+
+        db_conn.close()
+
+    # Show the plots
+
+    if args.graph_output and output is not None:
+
+        import matplotlib.pyplot as plt
+        plt.show()
 
-db.close()
+    # Time execution and save the metrics of each stage
 
+    end = time.time()
 
-# Show the plots
+    print('\nExecution time: ', end - start)
 
-plt.show()
+    if args.metrics_file is not None:
 
+        write_metrics(stage_metrics, args.metrics_file)
 
-# Time execution
 
-end = time.time()
+if __name__ == '__main__':
 
-print('\nExecution time: ', end - start)
+    main()
@@ -16,17 +16,29 @@
 # Import the libraries
 
 import os
+import sys
+import math
+import glob
+import json
+import shutil
+import time
+import bisect
+import hashlib
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+from itertools import product
+from pandas.tseries.frequencies import to_offset
 
 
-# Create the directory to store the images:
+# Create the in-memory catalog of tables and calendars
 
-if not os.path.isdir('images_extract_data'):
+catalog_tables = {}
+catalog_schedules = {}
 
-    os.mkdir('images_extract_data')
+
+# Create the record of the peak resident memory of the finished child processes already counted in the metrics
+
+peak_rss_children = [0]
 
 
 # ------------------------------------------------------------------------------------------------------------------------------------------
@@ -59,63 +71,1289 @@ def print_output(output_, print_output_flag_, head_flag_):
         print('"Print output" is not active')
 
 
-# Create a function to display the plots of the specified symbols and dates
+# Create a function to sort a dataframe by symbol and date and index the offsets of the rows of each symbol and date
+
+def partition_index(output_):
+
+    if len(output_) == 0:
+
+        return output_, {}
+
+    output_sorted = output_.sort_values(['sym_root', 'date'], kind='mergesort')
+
+    symbol_codes, symbol_names = pd.factorize(output_sorted['sym_root'])
+    date_codes, date_names = pd.factorize(pd.to_datetime(output_sorted['date']))
+
+    change = np.flatnonzero((np.diff(symbol_codes) != 0) | (np.diff(date_codes) != 0)) + 1
+    starts = np.concatenate([[0], change])
+    ends = np.concatenate([change, [len(output_sorted)]])
+
+    index = {}
+
+    for start, end in zip(starts, ends):
+
+        key = (str(symbol_names[symbol_codes[start]]), date_names[date_codes[start]].strftime('%Y%m%d'))
+        index[key] = (start, end)
+
+    return output_sorted, index
+
+
+# Create a function to get the slice of the rows of a symbol on a date, or of a symbol on all dates, from the index
+
+def partition_slice(index_, symbol_, date_=None):
+
+    if date_ is not None:
+
+        start, end = index_.get((symbol_, pd.to_datetime(date_).strftime('%Y%m%d')), (0, 0))
+
+        return slice(start, end)
+
+    offsets = [offset for key, offset in index_.items() if key[0] == symbol_]
+
+    if len(offsets) == 0:
+
+        return slice(0, 0)
+
+    return slice(offsets[0][0], offsets[-1][1])
+
+
+# Create a function to select the rows of a symbol on a date, with the index if available
+
+def select_partition(output_, symbol_, date_, index_=None):
+
+    if index_ is not None:
+
+        return output_.iloc[partition_slice(index_, symbol_, date_)]
+
+    condition = (output_['sym_root'] == symbol_) & (pd.to_datetime(output_['date']) == pd.to_datetime(date_))
+
+    return output_.loc[condition]
+
+
+# Create a function to get the times of the rows of a partition: from the index of the bars, or from the date and time_m of the trades
+
+def partition_times(partition_):
+
+    if isinstance(partition_.index, pd.DatetimeIndex):
+
+        return partition_.index.values
+
+    return pd.to_datetime(partition_['date']).values + partition_['time_m'].values.astype('timedelta64[ns]')
+
+
+# Create a function to decimate a series to the first, min, max and last point of each of n_buckets_ buckets, which keeps every spike
+
+def decimate_minmax(y_, n_buckets_):
+
+    if len(y_) <= 4 * n_buckets_:
+
+        return np.arange(len(y_))
+
+    y_min = np.where(np.isnan(y_), np.inf, y_)
+    y_max = np.where(np.isnan(y_), -np.inf, y_)
+    edges = np.linspace(0, len(y_), n_buckets_ + 1).astype('int64')
+    positions = []
+
+    for beg, end in zip(edges[:-1], edges[1:]):
+
+        positions.extend([beg, beg + np.argmin(y_min[beg:end]), beg + np.argmax(y_max[beg:end]), end - 1])
+
+    return np.unique(positions)
+
+
+# Create a function to prepare the panels of the plots: the symbol, date and usage, and the times and prices of each symbol-day, decimated
+# to n_points_ buckets if given
+
+def graph_panels(output_, symbol_date_list_, usage_, index_=None, n_points_=None):
+
+    panels = []
+
+    for symbol, date in symbol_date_list_:
+
+        partition = select_partition(output_, symbol, date, index_)
+        x = partition_times(partition)
+        y = partition['price'].values.astype('float64')
+
+        if n_points_ is not None:
+
+            positions = decimate_minmax(y, n_points_)
+            x, y = x[positions], y[positions]
+
+        panels.append((symbol, str(pd.to_datetime(date))[:10], usage_, x, y))
+
+    return panels
+
+
+# Create a function to set the non-interactive backend in the processes which render the plots
+
+def graph_backend_agg():
+
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+# Create a function to locate the ticks of the time axis: every 3 minutes on short windows, and a few readable ticks on longer ones
+
+def graph_locator(x_):
+
+    import matplotlib.dates as mdates
+
+    if len(x_) > 0 and (x_[-1] - x_[0]) > np.timedelta64(30, 'm'):
+
+        return mdates.AutoDateLocator(minticks=3, maxticks=8)
 
-def graph_output(output_, symbol_list_, date_index_, usage_):
+    return mdates.MinuteLocator(interval=3)
 
-    date_grid, symbol_grid = np.meshgrid(date_index_, symbol_list_)
-    date_symbol = np.array([date_grid.ravel(), symbol_grid.ravel()]).T
 
-    h = len(date_index_)
-    w = len(symbol_list_)
+# Create a function to render the plots of the specified symbols and dates
 
-    fig, ax = plt.subplots(nrows=h, ncols=w, figsize=(20, 10))
-    ax = ax.flatten()
+def render_output(panels_, h_, w_, usage_):
 
-    for i in range(len(date_symbol)):
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
 
-        symbol = date_symbol[i, 1]
-        date = pd.to_datetime(date_symbol[i, 0])
-        condition = (output_['sym_root'] == symbol) & (pd.to_datetime(output_['date']) == date)
-        y = output_.loc[condition, 'price']
-        ax[i].plot(y, linewidth=0.2, color='blue')
-        ax[i].set_title('{} {} {}'.format(symbol, str(pd.to_datetime(date))[:10], usage_))
-        ax[i].xaxis.set_major_locator(mdates.MinuteLocator(interval=3))
+    fig, ax = plt.subplots(nrows=h_, ncols=w_, figsize=(20, 10))
+    ax = np.array(ax).flatten()
+
+    for i, (symbol, date, usage, x, y) in enumerate(panels_):
+
+        ax[i].plot(x, y, linewidth=0.2, color='blue')
+        ax[i].set_title('{} {} {}'.format(symbol, date, usage))
+        ax[i].xaxis.set_major_locator(graph_locator(x))
         ax[i].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
 
     fig.tight_layout()
+    os.makedirs('images_extract_data', exist_ok=True)
     plt.savefig('images_extract_data/z_{}.png'.format(usage_))
 
 
-# Create a function to display comparative plots for the same symbol and date but different output status
-
-def graph_comparison(output1_, output2_, symbol_, date_, usage1_, usage2_):
+# Create a function to render comparative plots for the same symbol and date but different output status
 
-    condition_1 = (output1_['sym_root'] == symbol_) & (pd.to_datetime(output1_['date']) == pd.to_datetime(date_))
-    y1 = output1_.loc[condition_1, 'price']
-    label1 = symbol_ + ', ' + str(pd.to_datetime(date_))[:10] + ', ' + usage1_
+def render_comparison(panels_, usage1_, usage2_):
 
-    condition_2 = (output2_['sym_root'] == symbol_) & (pd.to_datetime(output2_['date']) == pd.to_datetime(date_))
-    y2 = output2_.loc[condition_2, 'price']
-    label2 = symbol_ + ', ' + str(pd.to_datetime(date_))[:10] + ', ' + usage2_
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
 
     fig, ax = plt.subplots(1, 2, sharey=True, figsize=(15, 4))
 
-    ax[0].plot(y1, label=label1, linewidth=0.6, color='blue')
-    ax[0].grid(linewidth=0.3)
-    ax[0].xaxis.set_major_locator(mdates.MinuteLocator(interval=3))
-    ax[0].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-    ax[0].set_xlabel('time', fontsize=14)
-    ax[0].set_ylabel('price',  fontsize=14)
-    ax[0].legend()
-
-    ax[1].plot(y2, label=label2, linewidth=0.6, color='red')
-    ax[1].grid(linewidth=0.3)
-    ax[1].xaxis.set_major_locator(mdates.MinuteLocator(interval=3))
-    ax[1].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-    ax[1].set_xlabel('time', fontsize=14)
-    ax[1].set_ylabel('price', fontsize=14)
-    ax[1].legend()
+    for i, ((symbol, date, usage, x, y), color) in enumerate(zip(panels_, ['blue', 'red'])):
+
+        ax[i].plot(x, y, label=symbol + ', ' + date + ', ' + usage, linewidth=0.6, color=color)
+        ax[i].grid(linewidth=0.3)
+        ax[i].xaxis.set_major_locator(graph_locator(x))
+        ax[i].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+        ax[i].set_xlabel('time', fontsize=14)
+        ax[i].set_ylabel('price', fontsize=14)
+        ax[i].legend()
 
     fig.tight_layout()
+    os.makedirs('images_extract_data', exist_ok=True)
     plt.savefig('images_extract_data/z_{}_{}.png'.format(usage1_, usage2_))
+
+
+# Create a function to display the plots of the specified symbols and dates: with decimate_, each subplot is decimated to its width in
+# pixels; with executor_, the plots are rendered by the executor and its future is returned
+
+def graph_output(output_, symbol_list_, date_index_, usage_, index_=None, decimate_=False, executor_=None):
+
+    n_points = int(20 * 100 / len(symbol_list_)) if decimate_ else None
+    panels = graph_panels(output_, [(symbol, date) for date in date_index_ for symbol in symbol_list_], usage_, index_, n_points)
+
+    if executor_ is not None:
+
+        return executor_.submit(render_output, panels, len(date_index_), len(symbol_list_), usage_)
+
+    render_output(panels, len(date_index_), len(symbol_list_), usage_)
+
+
+# Create a function to display comparative plots for the same symbol and date but different output status
+
+def graph_comparison(output1_, output2_, symbol_, date_, usage1_, usage2_, index1_=None, index2_=None, decimate_=False, executor_=None):
+
+    n_points = int(15 * 100 / 2) if decimate_ else None
+    panels = graph_panels(output1_, [(symbol_, date_)], usage1_, index1_, n_points) + \
+             graph_panels(output2_, [(symbol_, date_)], usage2_, index2_, n_points)
+
+    if executor_ is not None:
+
+        return executor_.submit(render_comparison, panels, usage1_, usage2_)
+
+    render_comparison(panels, usage1_, usage2_)
+
+
+# Create a function to locate the file of a query in the local cache
+
+def cache_path(cache_dir_, date_, symbol_, cache_key_):
+
+    key_hash = hashlib.sha1(repr(cache_key_).encode()).hexdigest()[:16]
+
+    return os.path.join(cache_dir_, 'taqm_{}'.format(date_[:4]), 'ctm_{}'.format(date_), '{}_{}.parquet'.format(symbol_, key_hash))
+
+
+# Create a function to read a query from the local cache
+
+def read_cache(cache_file_):
+
+    if not os.path.isfile(cache_file_):
+
+        return None
+
+    try:
+
+        return pd.read_parquet(cache_file_)
+
+    except Exception:
+
+        print('*** WARNING: Could not read the cached file {}: the query will be run again.'.format(cache_file_))
+
+        return None
+
+
+# Create a function to write a query to the local cache
+
+def write_cache(queried_trades_, cache_file_):
+
+    os.makedirs(os.path.dirname(cache_file_), exist_ok=True)
+
+    cache_file_tmp = cache_file_ + '.tmp'
+    queried_trades_.reset_index(drop=True).to_parquet(cache_file_tmp, index=False)
+    os.replace(cache_file_tmp, cache_file_)
+
+
+# Create a function to list the dates already stored in an extracted dataset, or in one of the tables stored with it
+
+def dataset_dates(dataset_dir_, output_format_, name_='data'):
+
+    parquet_dir = os.path.join(dataset_dir_, '{}.parquet'.format(name_))
+    csv_file = os.path.join(dataset_dir_, '{}.csv'.format(name_))
+
+    if output_format_ == 'parquet' and os.path.isdir(parquet_dir):
+
+        return sorted(d[len('date='):] for d in os.listdir(parquet_dir) if d.startswith('date='))
+
+    elif output_format_ == 'csv' and os.path.isfile(csv_file):
+
+        return sorted(pd.read_csv(csv_file, usecols=['date'])['date'].unique())
+
+    return []
+
+
+# Create a function to write an extracted dataset, or one of the tables stored with it, as a csv file or as parquet files partitioned by
+# date, replacing the dataset or only the dates of the new data
+
+def write_dataset(data_, dataset_dir_, output_format_, append_=False, name_='data'):
+
+    os.makedirs(dataset_dir_, exist_ok=True)
+
+    if output_format_ == 'csv':
+
+        csv_file = os.path.join(dataset_dir_, '{}.csv'.format(name_))
+        stored_dates = dataset_dates(dataset_dir_, output_format_, name_) if append_ else []
+        new_dates = sorted({str(d) for d in data_['date']})
+
+        if len(stored_dates) == 0:
+
+            data_.to_csv(csv_file, index=False)
+
+        elif stored_dates[-1] < new_dates[0]:
+
+            data_.to_csv(csv_file, index=False, header=False, mode='a')
+
+        else:
+
+            stored = pd.read_csv(csv_file)
+            merged = pd.concat([stored[~stored['date'].isin(new_dates)], data_.astype({'date': str, 'time_m': str})])
+            merged.sort_values(['date', 'time_m'], kind='mergesort').to_csv(csv_file, index=False)
+
+        return
+
+    parquet_dir = os.path.join(dataset_dir_, '{}.parquet'.format(name_))
+
+    if os.path.isdir(parquet_dir) and not append_:
+
+        shutil.rmtree(parquet_dir)
+
+    data = pd.DataFrame({'timestamp': pd.DatetimeIndex(data_.index)})
+
+    for column in data_.columns.drop(['date', 'time_m']):
+
+        data[column] = data_[column].to_numpy()
+    day = data['timestamp'].dt.normalize()
+
+    for date, data_date in data.groupby(day, sort=True):
+
+        partition_file = os.path.join(parquet_dir, 'date={}'.format(date.strftime('%Y-%m-%d')), 'part-0.parquet')
+        os.makedirs(os.path.dirname(partition_file), exist_ok=True)
+        data_date.to_parquet(partition_file, index=False, compression='zstd')
+
+
+# Create a function to read the outlier and resampling parameters stored with an extracted dataset
+
+def read_dataset_params(dataset_dir_):
+
+    params_file = os.path.join(dataset_dir_, 'params.json')
+
+    if not os.path.isfile(params_file):
+
+        return None
+
+    with open(params_file) as file:
+
+        return json.load(file)
+
+
+# Create a function to store the outlier and resampling parameters with an extracted dataset
+
+def write_dataset_params(dataset_dir_, params_):
+
+    os.makedirs(dataset_dir_, exist_ok=True)
+
+    with open(os.path.join(dataset_dir_, 'params.json'), 'w') as file:
+
+        json.dump(params_, file, indent=4)
+
+
+# Create a function to read an extracted dataset, or one of the tables stored with it, from its parquet partitions if available, for the
+# given dates and columns
+
+def read_dataset(dataset_dir_, start_date_=None, end_date_=None, columns_=None, name_='data'):
+
+    columns = ['date', 'time_m', 'price', 'size'] if columns_ is None else list(columns_)
+    parquet_dir = os.path.join(dataset_dir_, '{}.parquet'.format(name_))
+
+    if os.path.isdir(parquet_dir):
+
+        filters = []
+
+        if start_date_ is not None:
+
+            filters.append(('date', '>=', start_date_))
+
+        if end_date_ is not None:
+
+            filters.append(('date', '<=', end_date_))
+
+        read_columns = ['timestamp', 'date'] + [column for column in columns if column not in ['date', 'time_m']]
+        data = pd.read_parquet(parquet_dir, columns=read_columns, filters=filters if filters else None)
+        data = data.sort_values('timestamp', kind='mergesort').reset_index(drop=True)
+        data['date'] = data['date'].astype(str)
+
+        if 'time_m' in columns:
+
+            data['time_m'] = data['timestamp'].dt.time.astype(str)
+
+    else:
+
+        data = pd.read_csv(os.path.join(dataset_dir_, '{}.csv'.format(name_)), usecols=list(set(columns) | {'date'}))
+
+        if start_date_ is not None:
+
+            data = data[data['date'] >= start_date_]
+
+        if end_date_ is not None:
+
+            data = data[data['date'] <= end_date_]
+
+    return data[columns].reset_index(drop=True)
+
+
+# Create a function to read the catalog of the extracted symbol-days, optionally filtered by a query on its columns, without loading any
+# price: e.g. read_catalog(dataset_root, "status == 'ok' and nan_ratio < 0.05")
+
+def read_catalog(catalog_dir_, query_=None):
+
+    catalog_file = os.path.join(catalog_dir_, 'catalog.csv')
+
+    if not os.path.isfile(catalog_file):
+
+        return None
+
+    catalog = pd.read_csv(catalog_file, dtype={'symbol': str, 'date': str, 'status': str, 'freq': str, 'bar_type': str})
+
+    if query_ is not None:
+
+        catalog = catalog.query(query_).reset_index(drop=True)
+
+    return catalog
+
+
+# Create a function to update the catalog of the extracted symbol-days, replacing the rows of the symbol-days extracted again
+
+def write_catalog(catalog_, catalog_dir_):
+
+    os.makedirs(catalog_dir_, exist_ok=True)
+
+    catalog_file = os.path.join(catalog_dir_, 'catalog.csv')
+    stored = read_catalog(catalog_dir_)
+
+    if stored is not None:
+
+        new_units = set(zip(catalog_['symbol'], catalog_['date']))
+        stored = stored[[unit not in new_units for unit in zip(stored['symbol'], stored['date'])]]
+        catalog_ = pd.concat([stored, catalog_], ignore_index=True)
+
+    catalog_ = catalog_.sort_values(['symbol', 'date'], kind='mergesort')
+    catalog_.to_csv(catalog_file + '.tmp', index=False)
+    os.replace(catalog_file + '.tmp', catalog_file)
+
+
+# Create a function to set the timeout of the queries run on a connection to the wrds cloud
+
+def set_query_timeout(db_, query_timeout_):
+
+    try:
+
+        import sqlalchemy
+        db_.connection.execute(sqlalchemy.text('SET statement_timeout = {}'.format(int(query_timeout_ * 1000))))
+
+        if hasattr(db_.connection, 'commit'):
+
+            db_.connection.commit()
+
+    except Exception:
+
+        print('*** WARNING: Could not set the timeout of the queries on the connection: the queries will run without timeout.')
+
+
+# Create a function to roll back the transaction of a failed query, which a timeout leaves aborted, so that the query can be run again on
+# the same connection
+
+def rollback_query(db_):
+
+    connection = getattr(db_, 'connection', None)
+
+    if hasattr(connection, 'rollback'):
+
+        try:
+
+            connection.rollback()
+
+        except Exception:
+
+            print('*** WARNING: Could not roll back the failed query on the connection.')
+
+
+# Create a function to stream the results of the queries run on a connection to the wrds cloud through a server-side cursor, which sends
+# the rows in chunks instead of the whole result set at once
+
+def set_stream_results(db_):
+
+    if hasattr(getattr(db_, 'connection', None), 'execution_options'):
+
+        db_.connection = db_.connection.execution_options(stream_results=True)
+
+
+# Create a function to check whether a file of the local catalog exists and has not expired
+
+def is_fresh(catalog_file_, catalog_expiry_):
+
+    return os.path.isfile(catalog_file_) and time.time() - os.path.getmtime(catalog_file_) < catalog_expiry_ * 3600
+
+
+# Create a function to list the tables of a library once per run and persist the list to the local catalog
+
+def list_tables_cached(db_, library_, catalog_dir_, catalog_expiry_):
+
+    if library_ in catalog_tables:
+
+        return catalog_tables[library_]
+
+    catalog_file = None if catalog_dir_ is None else os.path.join(catalog_dir_, 'tables_{}.json'.format(library_))
+
+    if catalog_file is not None and is_fresh(catalog_file, catalog_expiry_):
+
+        with open(catalog_file) as file:
+
+            catalog_tables[library_] = set(json.load(file))
+
+    else:
+
+        catalog_tables[library_] = set(db_.list_tables(library=library_))
+
+        if catalog_file is not None:
+
+            os.makedirs(catalog_dir_, exist_ok=True)
+
+            with open(catalog_file, 'w') as file:
+
+                json.dump(sorted(catalog_tables[library_]), file)
+
+    return catalog_tables[library_]
+
+
+# Create a function to compute the trading days of a market calendar once per run and persist them to the local catalog
+
+def schedule_cached(calendar_, start_date_, end_date_, catalog_dir_, catalog_expiry_):
+
+    schedule_key = (calendar_, start_date_, end_date_)
+
+    if schedule_key in catalog_schedules:
+
+        return catalog_schedules[schedule_key]
+
+    catalog_file = None if catalog_dir_ is None else os.path.join(catalog_dir_, 'schedule_{}_{}_{}.json'.format(*schedule_key))
+
+    if catalog_file is not None and is_fresh(catalog_file, catalog_expiry_):
+
+        with open(catalog_file) as file:
+
+            catalog_schedules[schedule_key] = pd.DatetimeIndex(json.load(file))
+
+    else:
+
+        import pandas_market_calendars as mcal
+
+        schedule = mcal.get_calendar(calendar_).schedule(start_date=start_date_, end_date=end_date_)
+        catalog_schedules[schedule_key] = schedule.index
+
+        if catalog_file is not None:
+
+            os.makedirs(catalog_dir_, exist_ok=True)
+
+            with open(catalog_file, 'w') as file:
+
+                json.dump([str(d)[:10] for d in schedule.index], file)
+
+    return catalog_schedules[schedule_key]
+
+
+# Create a function to convert a chunk of queried trades to compact dtypes: categorical strings, dates and int64 nanosecond times
+
+def compact_trades(queried_trades_, price_dtype_):
+
+    compact_chunk = pd.DataFrame(index=queried_trades_.index)
+
+    for column in queried_trades_.columns:
+
+        if column == 'date':
+
+            compact_chunk[column] = pd.to_datetime(queried_trades_[column])
+
+        elif column == 'time_m' and queried_trades_[column].dtype != 'int64':
+
+            compact_chunk[column] = pd.to_timedelta(queried_trades_[column].astype(str)).values.astype('int64')
+
+        elif column == 'size':
+
+            compact_chunk[column] = queried_trades_[column].astype('int32')
+
+        elif column == 'price':
+
+            compact_chunk[column] = queried_trades_[column].astype(price_dtype_)
+
+        elif queried_trades_[column].dtype == object:
+
+            compact_chunk[column] = queried_trades_[column].astype('category')
+
+        else:
+
+            compact_chunk[column] = queried_trades_[column]
+
+    return compact_chunk
+
+
+# Create a function to concatenate the chunks of queried trades column by column in a single pass
+
+def concat_trades(chunks_):
+
+    if len(chunks_) == 0:
+
+        return pd.DataFrame([])
+
+    columns = {}
+
+    for column in chunks_[0].columns:
+
+        if isinstance(chunks_[0][column].dtype, pd.CategoricalDtype):
+
+            columns[column] = pd.api.types.union_categoricals([chunk[column] for chunk in chunks_], sort_categories=True)
+
+        else:
+
+            columns[column] = np.concatenate([chunk[column].values for chunk in chunks_])
+
+    index = np.concatenate([chunk.index.values for chunk in chunks_])
+
+    return pd.DataFrame(columns, index=index)
+
+
+# Create a function to decode the chunks of a streamed query into compact columns as they arrive, so that only one chunk of the query is
+# held with object columns at a time
+
+def stream_trades(chunks_, price_dtype_):
+
+    compact_chunks = [compact_trades(chunk, price_dtype_) for chunk in chunks_]
+
+    return concat_trades(compact_chunks).reset_index(drop=True)
+
+
+# Define the condition codes of 'tr_scond' encoded in the bits of the condition mask
+
+condition_codes = '@ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+
+# Create a function to compute the bitmask of a set of condition codes
+
+def condition_mask(codes_):
+
+    return np.uint64(sum(1 << condition_codes.index(code) for code in set(codes_) if code in condition_codes))
+
+
+# Create a function to encode the 'tr_scond' of the queried trades as the bitmask of their condition codes: the mask is computed once for
+# each distinct 'tr_scond', which are few, and mapped to the trades through the categorical codes
+
+def encode_conditions(queried_trades_):
+
+    tr_scond = queried_trades_['tr_scond'].astype('category')
+    category_mask = np.array([condition_mask(s) for s in tr_scond.cat.categories] + [0], dtype='uint64')
+
+    return queried_trades_.assign(tr_scond=tr_scond, tr_scond_mask=category_mask[tr_scond.cat.codes.values])
+
+
+# Create a function to select the trades kept by a filter policy with vectorized operations on the encoded condition codes: the trades with
+# a 'tr_corr' in 'tr_corr_keep' and without any 'tr_scond' in 'tr_scond_drop' are kept, and the trades without 'tr_scond' are discarded as
+# by the SQL filter
+
+def policy_mask(queried_trades_, policy_):
+
+    scond_keep = (queried_trades_['tr_scond_mask'].values & condition_mask(policy_['tr_scond_drop'])) == 0
+
+    return scond_keep & queried_trades_['tr_scond'].notna().values & queried_trades_['tr_corr'].isin(policy_['tr_corr_keep']).values
+
+
+# Create a function to report the memory footprint of a dataframe
+
+def memory_footprint(output_):
+
+    footprint = output_.memory_usage(deep=True).rename('bytes').to_frame()
+    footprint['dtype'] = pd.Series(output_.dtypes.astype(str))
+    footprint.loc['Total', 'bytes'] = footprint['bytes'].sum()
+    footprint['bytes'] = footprint['bytes'].astype('int64')
+
+    return footprint
+
+
+# Create a function to locate the checkpoint of a stage for a symbol on a date
+
+def partition_path(checkpoint_dir_, stage_, symbol_, date_):
+
+    return os.path.join(checkpoint_dir_, stage_, symbol_, '{}.parquet'.format(date_))
+
+
+# Create a function to check that a checkpoint is resumed with the same settings that created it: the settings are written atomically, as
+# the shards of a run may start at the same time
+
+def check_checkpoint_run(checkpoint_dir_, run_settings_):
+
+    run_file = os.path.join(checkpoint_dir_, 'run.json')
+
+    if os.path.isfile(run_file):
+
+        with open(run_file) as file:
+
+            checkpoint_settings = json.load(file)
+
+        if checkpoint_settings != run_settings_:
+
+            raise ValueError('The checkpoint in {} was created with different settings: {}.'.format(checkpoint_dir_, checkpoint_settings))
+
+    else:
+
+        os.makedirs(checkpoint_dir_, exist_ok=True)
+
+        with open('{}.{}'.format(run_file, os.getpid()), 'w') as file:
+
+            json.dump(run_settings_, file)
+
+        os.replace('{}.{}'.format(run_file, os.getpid()), run_file)
+
+
+# Create a function to locate the manifest of a run, or of a shard of a run split across array tasks
+
+def manifest_path(checkpoint_dir_, shard_id_=None):
+
+    if shard_id_ is None:
+
+        return os.path.join(checkpoint_dir_, 'manifest.csv')
+
+    return os.path.join(checkpoint_dir_, 'manifest_shard_{}.csv'.format(shard_id_))
+
+
+# Create a function to read the symbol-date units of a stage recorded in the manifests with one of the given statuses: the manifests of all
+# the shards are merged and the last entry of each unit is kept
+
+def read_manifest(checkpoint_dir_, stage_, status_list_):
+
+    manifest_files = sorted(glob.glob(os.path.join(checkpoint_dir_, 'manifest*.csv')))
+
+    if len(manifest_files) == 0:
+
+        return set()
+
+    manifest = pd.concat([pd.read_csv(manifest_file, dtype={'symbol': str, 'date': str, 'stage': str, 'status': str})
+                          for manifest_file in manifest_files], ignore_index=True)
+    manifest = manifest.sort_values('time', kind='mergesort')
+    manifest = manifest[manifest['stage'] == stage_].drop_duplicates(['symbol', 'date'], keep='last')
+    manifest = manifest[manifest['status'].isin(status_list_)]
+
+    return set(zip(manifest['symbol'], manifest['date']))
+
+
+# Create a function to append the entry of a symbol-date unit to the manifest of the run, or of the shard
+
+def write_manifest_entry(checkpoint_dir_, symbol_, date_, stage_, status_, rows_, shard_id_=None):
+
+    manifest_file = manifest_path(checkpoint_dir_, shard_id_)
+    new_file = not os.path.isfile(manifest_file)
+
+    os.makedirs(checkpoint_dir_, exist_ok=True)
+
+    with open(manifest_file, 'a') as file:
+
+        if new_file:
+
+            file.write('symbol,date,stage,status,rows,time\n')
+
+        file.write('{},{},{},{},{},{}\n'.format(symbol_, date_, stage_, status_, rows_, time.strftime('%Y-%m-%d %H:%M:%S')))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+# Create a function to select the symbol-date units of a shard: the units are ordered by date and symbol and split in n_shards_ contiguous
+# blocks, so that the symbols of a date stay in the same shard and can be queried in a batch
+
+def shard_units(symbol_list_, date_list_, shard_id_, n_shards_):
+
+    units = [(symbol, date) for date, symbol in product(date_list_, symbol_list_)]
+
+    return units[len(units) * (shard_id_ - 1) // n_shards_:len(units) * shard_id_ // n_shards_]
+
+
+# Create a function to compute the rolling mean and std of the trimmed window [perc_b_:perc_t_] of k_ centered observations
+
+def rolling_trimmed_stats(values_, k_, perc_b_, perc_t_):
+
+    k = int(k_)
+    n = len(values_)
+    center_beg = int((k - 1) / 2)
+    center_end = n - center_beg
+
+    mean_rolling = np.repeat(np.nan, n)
+    std_rolling = np.repeat(np.nan, n)
+
+    if center_end <= center_beg:
+
+        return mean_rolling, std_rolling
+
+    values = np.asarray(values_, dtype='float64').tolist()
+    window = sorted(values[:k])
+    trim_num = len(window[perc_b_:perc_t_])
+
+    for i in range(center_beg, center_end):
+
+        # Resum the trimmed window every k steps around one of its values, to limit the rounding of the running sums
+
+        if (i - center_beg) % k == 0:
+
+            ref = window[perc_b_]
+            trim_sum = sum(v - ref for v in window[perc_b_:perc_t_])
+            trim_sum_sq = sum((v - ref) ** 2 for v in window[perc_b_:perc_t_])
+
+        if window[perc_b_] == window[min(perc_t_, k) - 1]:
+
+            mean_rolling[i] = window[perc_b_]
+            std_rolling[i] = 0.0
+
+        else:
+
+            trim_mean = trim_sum / trim_num
+            mean_rolling[i] = ref + trim_mean
+            std_rolling[i] = max(trim_sum_sq / trim_num - trim_mean ** 2, 0.0) ** 0.5
+
+        if i < center_end - 1:
+
+            # Drop the oldest value: the values ranked above it move down by one position, unless the trimmed window reaches the top of the
+            # window, where no value moves into it
+
+            idx_drop = bisect.bisect_left(window, values[i - center_beg])
+
+            if idx_drop < perc_t_:
+
+                value_old = window[max(idx_drop, perc_b_)] - ref
+                value_new = window[perc_t_] - ref if perc_t_ < len(window) else 0.0
+                trim_sum += value_new - value_old
+                trim_sum_sq += value_new ** 2 - value_old ** 2
+
+            del window[idx_drop]
+
+            # Add the newest value: the values ranked above it move up by one position, unless the trimmed window reaches the top of the
+            # window, where no value moves out of it
+
+            value_in = values[i + center_beg + 1]
+            idx_add = bisect.bisect_left(window, value_in)
+
+            if idx_add < perc_t_:
+
+                value_old = window[perc_t_ - 1] - ref if perc_t_ <= len(window) else 0.0
+                value_new = (window[perc_b_ - 1] if idx_add < perc_b_ else value_in) - ref
+                trim_sum += value_new - value_old
+                trim_sum_sq += value_new ** 2 - value_old ** 2
+
+            window.insert(idx_add, value_in)
+
+    return mean_rolling, std_rolling
+
+
+# Create a function to find the (k, y) pair that flags the fewest outliers of a symbol: the rolling statistics depend only on k, so they
+# are computed once per k and compared with the thresholds of all the y at once
+
+def filter_outliers(price_days_, ky_array_, delta_):
+
+    k_values = list(dict.fromkeys(ky_array_[:, 0]))
+    y_values = list(dict.fromkeys(ky_array_[:, 1]))
+    y_row = np.array(y_values)[np.newaxis, :]
+
+    outlier_num = np.zeros((len(k_values), len(y_values)), dtype='int64')
+    not_outlier = [[] for _ in k_values]
+
+    for pos_k, k in enumerate(k_values):
+
+        perc_b = int(k * delta_)
+        perc_t = int(k * (1 - delta_) + 1)
+        center_beg = int((k - 1) / 2)
+
+        for price_day in price_days_:
+
+            center_end = len(price_day) - center_beg
+
+            mean_rolling, std_rolling = rolling_trimmed_stats(price_day, k, perc_b, perc_t)
+
+            mean_rolling[:center_beg] = mean_rolling[center_beg]
+            mean_rolling[center_end:] = mean_rolling[center_end - 1]
+            std_rolling[:center_beg] = std_rolling[center_beg]
+            std_rolling[center_end:] = std_rolling[center_end - 1]
+
+            left_con = np.abs(price_day - mean_rolling)[:, np.newaxis]
+            right_con = (3 * std_rolling)[:, np.newaxis] + y_row
+
+            outlier_num[pos_k] += (left_con > right_con).sum(axis=0)
+            not_outlier[pos_k].append(left_con < right_con)
+
+    pos_best = None
+
+    for k, y in ky_array_:
+
+        pos_ky = (k_values.index(k), y_values.index(y))
+
+        if pos_best is None or outlier_num[pos_ky] < outlier_num[pos_best]:
+
+            pos_best = pos_ky
+
+    not_outlier_best = [not_outlier_day[:, pos_best[1]] for not_outlier_day in not_outlier[pos_best[0]]]
+
+    return outlier_num[pos_best], k_values[pos_best[0]], y_values[pos_best[1]], not_outlier_best
+
+
+# Create a function to find the (k, y) pair of a symbol as filter_outliers and measure its wall time, also when it runs in another process
+
+def filter_outliers_timed(price_days_, ky_array_, delta_):
+
+    start = time.time()
+
+    return filter_outliers(price_days_, ky_array_, delta_) + (time.time() - start,)
+
+
+# Create a function to map the integer times of the aggregated trades to the cells of their symbol-date unit and bucket: the buckets are
+# closed and labeled on the right, and only the buckets on the grid of the session are kept
+
+def bucket_cells(output_aggregate_, index_, symbol_list_, date_list_, start_time_, end_time_, freq_):
+
+    freq_ns = to_offset(freq_).nanos
+    start_ns = pd.Timedelta(start_time_).value
+    end_ns = pd.Timedelta(end_time_).value
+    num_grid = (end_ns - start_ns) // freq_ns + 1
+
+    unit_rows = np.zeros(len(output_aggregate_), dtype='int64')
+    keep_rows = np.zeros(len(output_aggregate_), dtype=bool)
+
+    for pos_unit, (symbol, date) in enumerate(product(symbol_list_, date_list_)):
+
+        rows = partition_slice(index_, symbol, date)
+        unit_rows[rows] = pos_unit
+        keep_rows[rows] = True
+
+    time_m = output_aggregate_['time_m'].values
+    label_ns = -(-time_m // freq_ns) * freq_ns
+    bucket = (label_ns - start_ns) // freq_ns
+    keep_rows &= ((label_ns - start_ns) % freq_ns == 0) & (bucket >= 0) & (bucket < num_grid)
+
+    return (unit_rows * num_grid + bucket)[keep_rows], keep_rows, num_grid
+
+
+# Create a function to count the empty buckets of each symbol at each candidate frequency, without building the bars
+
+def count_empty_buckets(output_aggregate_, index_, symbol_list_, date_list_, start_time_, end_time_, freq_list_):
+
+    num_nan = np.zeros((len(symbol_list_), len(freq_list_)), dtype='int64')
+    num_tot = np.zeros((len(symbol_list_), len(freq_list_)), dtype='int64')
+
+    for pos_freq, freq in enumerate(freq_list_):
+
+        cell, _, num_grid = bucket_cells(output_aggregate_, index_, symbol_list_, date_list_, start_time_, end_time_, freq)
+
+        cell_occupied = cell[np.diff(cell, prepend=-1) != 0]
+        num_occupied = np.bincount(cell_occupied // (num_grid * len(date_list_)), minlength=len(symbol_list_))
+
+        num_tot[:, pos_freq] = len(date_list_) * num_grid
+        num_nan[:, pos_freq] = num_tot[:, pos_freq] - num_occupied
+
+    return num_nan, num_tot
+
+
+# Create a function to compute the coarsest bucket which divides each of the frequencies, so that the bars of every frequency are unions of
+# whole buckets
+
+def common_bucket(freq_list_):
+
+    bucket = 0
+
+    for freq in freq_list_:
+
+        bucket = math.gcd(bucket, pd.Timedelta(freq).value)
+
+    offset = to_offset(pd.Timedelta(bucket))
+
+    return '{}{}'.format(offset.n, offset.rule_code)
+
+
+# Create a function to reduce the rows of each cell to the open, high, low and close price, the total size, value and count, and the
+# realized variance and bipower variation: the rows of a cell are contiguous and sorted by time, and the returns start again with each unit
+
+def reduce_cells(cell_, unit_, price_, size_, count_, num_cells_):
+
+    cell_first = np.flatnonzero(np.diff(cell_, prepend=-1) != 0)
+    cell_last = np.flatnonzero(np.diff(cell_, append=num_cells_) != 0)
+
+    bar_close = np.full(num_cells_, np.nan)
+    bar_open = np.full(num_cells_, np.nan)
+    bar_high = np.full(num_cells_, np.nan)
+    bar_low = np.full(num_cells_, np.nan)
+
+    bar_close[cell_[cell_last]] = price_[cell_last]
+    bar_open[cell_[cell_first]] = price_[cell_first]
+
+    if len(cell_) > 0:
+
+        bar_high[cell_[cell_first]] = np.maximum.reduceat(price_, cell_first)
+        bar_low[cell_[cell_first]] = np.minimum.reduceat(price_, cell_first)
+
+    bar_size = np.bincount(cell_, weights=size_, minlength=num_cells_)
+    bar_value = np.bincount(cell_, weights=price_ * size_, minlength=num_cells_)
+    bar_count = np.bincount(cell_, weights=count_, minlength=num_cells_).astype('int64')
+
+    # Sum the squared log returns and the products of adjacent absolute log returns of the rows of each cell: each return belongs to the
+    # cell where it ends, and the first row of each unit has no return
+
+    same_unit = np.diff(unit_, prepend=-1) == 0
+    log_return = np.where(same_unit, np.diff(np.log(price_), prepend=np.log(price_[:1])), 0)
+    abs_return = np.abs(log_return)
+
+    bar_rv = np.bincount(cell_, weights=log_return ** 2, minlength=num_cells_)
+    bar_bv = np.pi / 2 * np.bincount(cell_, weights=abs_return * np.concatenate([[0], abs_return[:-1]]), minlength=num_cells_)
+
+    return bar_open, bar_high, bar_low, bar_close, bar_size, bar_value, bar_count, bar_rv, bar_bv
+
+
+# Create a function to build the bars of all the symbols and dates at once from the bucket cells, filling the empty buckets as in a
+# resample joined on the grid of the session
+
+def build_bars(output_aggregate_, index_, symbol_list_, date_list_, start_time_, end_time_, freq_):
+
+    cell, keep_rows, num_grid = bucket_cells(output_aggregate_, index_, symbol_list_, date_list_, start_time_, end_time_, freq_)
+    freq_ns = to_offset(freq_).nanos
+    start_ns = pd.Timedelta(start_time_).value
+    num_units = len(symbol_list_) * len(date_list_)
+
+    price = output_aggregate_['price'].values[keep_rows].astype('float64')
+    size = output_aggregate_['size'].values[keep_rows].astype('float64')
+    count = output_aggregate_['count'].values[keep_rows] if 'count' in output_aggregate_ else np.ones(len(cell), dtype='int64')
+
+    # Reduce the rows of each cell: the units of the cells are the symbol-dates
+
+    num_cells = num_units * num_grid
+    bar_open, bar_high, bar_low, bar_close, bar_size, bar_value, bar_count, bar_rv, bar_bv = \
+        reduce_cells(cell, cell // num_grid, price, size, count, num_cells)
+
+    bar_close = bar_close.reshape(num_units, num_grid)
+    bar_size = bar_size.reshape(num_units, num_grid)
+    occupied = bar_count.reshape(num_units, num_grid) > 0
+
+    # Locate the previous and next occupied bucket of each bucket
+
+    position = np.arange(num_grid)
+    pos_prev = np.maximum.accumulate(np.where(occupied, position, -1), axis=1)
+    pos_next = np.minimum.accumulate(np.where(occupied, position, num_grid)[:, ::-1], axis=1)[:, ::-1]
+    has_prev = pos_prev >= 0
+    has_next = pos_next < num_grid
+
+    unit_grid = np.arange(num_units)[:, np.newaxis]
+    close_prev = bar_close[unit_grid, np.where(has_prev, pos_prev, 0)]
+    close_next = bar_close[unit_grid, np.where(has_next, pos_next, 0)]
+
+    # Interpolate the price linearly between occupied buckets, carry it forward at the end and backward at the start of the session
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+
+        slope = (close_next - close_prev) / (pos_next - pos_prev)
+        price_filled = slope * (position - pos_prev) + close_prev
+
+    price_filled = np.where(occupied, bar_close, price_filled)
+    price_filled = np.where(has_prev & ~has_next, close_prev, price_filled)
+    price_filled = np.where(~has_prev, np.where(has_next, close_next, np.nan), price_filled)
+
+    # Sum the volume between the first and last occupied buckets, back-fill it at the start and leave it missing at the end
+
+    first_occupied = np.where(occupied.any(axis=1), occupied.argmax(axis=1), num_grid)[:, np.newaxis]
+    last_occupied = np.where(occupied.any(axis=1), num_grid - 1 - occupied[:, ::-1].argmax(axis=1), -1)[:, np.newaxis]
+    size_first = bar_size[np.arange(num_units), np.minimum(first_occupied[:, 0], num_grid - 1)][:, np.newaxis]
+
+    size_filled = np.where(position < first_occupied, size_first, bar_size)
+    size_filled = np.where(position > last_occupied, np.nan, size_filled)
+
+    # Assemble the bars
+
+    price_filled = price_filled.ravel()
+    empty = ~occupied.ravel()
+
+    date_ns = pd.to_datetime(pd.Series(date_list_)).values.astype('int64')
+    index_bars = pd.DatetimeIndex(np.tile(np.repeat(date_ns, num_grid) + np.tile(start_ns + position * freq_ns, len(date_list_)),
+                                          len(symbol_list_)))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+
+        bar_vwap = bar_value / bar_size.ravel()
+
+    output_resampled = pd.DataFrame({'sym_root': np.repeat(symbol_list_, len(date_list_) * num_grid),
+                                     'date': index_bars.date,
+                                     'time_m': index_bars.time,
+                                     'price': price_filled,
+                                     'size': size_filled.ravel(),
+                                     'open': np.where(empty, price_filled, bar_open),
+                                     'high': np.where(empty, price_filled, bar_high),
+                                     'low': np.where(empty, price_filled, bar_low),
+                                     'vwap': np.where(empty, price_filled, bar_vwap),
+                                     'count': bar_count,
+                                     'rv': bar_rv,
+                                     'bv': bar_bv}, index=index_bars)
+
+    return output_resampled
+
+
+# Create a function to build the tick, volume or dollar bars of all the symbols and dates at once in one pass over the stream of trades: a
+# bar closes with the trade at which the cumulative number of trades, shares or dollars of the day reaches a multiple of bar_size_, and the
+# last bar of each day closes with its last trade
+
+def build_event_bars(output_aggregate_, index_, symbol_list_, date_list_, bar_type_, bar_size_):
+
+    unit_rows = [np.arange(len(output_aggregate_))[partition_slice(index_, symbol, date)]
+                 for symbol, date in product(symbol_list_, date_list_)]
+    rows = np.concatenate(unit_rows)
+    unit = np.repeat(np.arange(len(unit_rows)), [len(rows_unit) for rows_unit in unit_rows])
+
+    price = output_aggregate_['price'].values[rows].astype('float64')
+    size = output_aggregate_['size'].values[rows].astype('float64')
+    count = output_aggregate_['count'].values[rows] if 'count' in output_aggregate_ else np.ones(len(rows), dtype='int64')
+
+    # Assign each trade to its bar from the cumulative measure of its day before the trade
+
+    measure = {'tick': count, 'volume': size, 'dollar': price * size}[bar_type_]
+    measure_units = np.split(measure, np.cumsum([len(rows_unit) for rows_unit in unit_rows])[:-1])
+    cum_measure = np.concatenate([np.concatenate([[0], np.cumsum(measure_unit)])[:len(measure_unit)] for measure_unit in measure_units])
+
+    bar = np.floor(cum_measure / bar_size_)
+    cell = np.cumsum((np.diff(unit, prepend=-1) != 0) | (np.diff(bar, prepend=-1) != 0)) - 1
+    num_cells = cell[-1] + 1 if len(cell) > 0 else 0
+
+    bar_open, bar_high, bar_low, bar_close, bar_size, bar_value, bar_count, bar_rv, bar_bv = \
+        reduce_cells(cell, unit, price, size, count, num_cells)
+
+    # Assemble the bars at the time of their last trade
+
+    cell_last = np.flatnonzero(np.diff(cell, append=num_cells) != 0)
+    index_bars = pd.DatetimeIndex(pd.to_datetime(output_aggregate_['date'].values[rows][cell_last]) +
+                                  pd.to_timedelta(output_aggregate_['time_m'].values[rows][cell_last]))
+
+    output_bars = pd.DataFrame({'sym_root': np.array(symbol_list_)[unit[cell_last] // len(date_list_)],
+                                'date': index_bars.date,
+                                'time_m': index_bars.time,
+                                'price': bar_close,
+                                'size': bar_size,
+                                'open': bar_open,
+                                'high': bar_high,
+                                'low': bar_low,
+                                'vwap': bar_value / bar_size,
+                                'count': bar_count,
+                                'rv': bar_rv,
+                                'bv': bar_bv}, index=index_bars)
+
+    return output_bars
+
+
+# Create a function to compute the realized measures of the bars of a symbol: the realized variance, the bipower variation, the trade count
+# and the realized range of each bar, and of each day at the end of the session
+
+def realized_features(bars_, end_time_):
+
+    features = pd.DataFrame({'date': bars_['date'], 'time_m': bars_['time_m'], 'rv': bars_['rv'], 'bv': bars_['bv'],
+                             'count': bars_['count'], 'range': np.log(bars_['high'] / bars_['low'])}, index=bars_.index)
+
+    features_day = bars_.groupby('date', sort=True).agg(rv=('rv', 'sum'), bv=('bv', 'sum'), count=('count', 'sum'), high=('high', 'max'),
+                                                        low=('low', 'min'))
+    index_day = pd.DatetimeIndex(pd.to_datetime(pd.Series(features_day.index)) + pd.Timedelta(end_time_))
+
+    features_day = pd.DataFrame({'date': features_day.index.values, 'time_m': index_day.time, 'rv': features_day['rv'].values,
+                                 'bv': features_day['bv'].values, 'count': features_day['count'].values,
+                                 'range': np.log(features_day['high'] / features_day['low']).values}, index=index_day)
+
+    return features, features_day
+
+
+# Create a function to join the trades of a symbol-day to the prevailing quotes, streamed in chunks sorted by time: each trade takes the
+# last quote at or before its time, and only the last quote of the previous chunk is carried to the next one
+
+def asof_join_quotes(trade_times_, quote_chunks_):
+
+    bid = np.full(len(trade_times_), np.nan)
+    ask = np.full(len(trade_times_), np.nan)
+
+    carry_times = np.empty(0, dtype='int64')
+    carry_bid = np.empty(0)
+    carry_ask = np.empty(0)
+    pos_done = 0
+
+    for quote_chunk in quote_chunks_:
+
+        if len(quote_chunk) == 0:
+
+            continue
+
+        quote_times = np.concatenate([carry_times, pd.to_timedelta(quote_chunk['time_m'].astype(str)).values.astype('int64')])
+        quote_bid = np.concatenate([carry_bid, quote_chunk['best_bid'].to_numpy(dtype='float64')])
+        quote_ask = np.concatenate([carry_ask, quote_chunk['best_ask'].to_numpy(dtype='float64')])
+
+        pos_end = np.searchsorted(trade_times_, quote_times[-1], side='left')
+        pos_quote = np.searchsorted(quote_times, trade_times_[pos_done:pos_end], side='right') - 1
+        matched = pos_quote >= 0
+
+        bid[pos_done:pos_end][matched] = quote_bid[pos_quote[matched]]
+        ask[pos_done:pos_end][matched] = quote_ask[pos_quote[matched]]
+
+        carry_times, carry_bid, carry_ask = quote_times[-1:], quote_bid[-1:], quote_ask[-1:]
+        pos_done = pos_end
+
+    if len(carry_times) > 0:
+
+        bid[pos_done:] = carry_bid[0]
+        ask[pos_done:] = carry_ask[0]
+
+    return bid, ask
+
+
+# Create a function to sign the trades with the quote rule, and with the tick rule for the trades at the mid or without a quote
+
+def trade_signs(price_, mid_):
+
+    tick = np.sign(np.diff(price_, prepend=np.nan))
+    tick = pd.Series(np.where(tick == 0, np.nan, tick)).ffill().to_numpy()
+
+    sign = np.sign(price_ - mid_)
+
+    return np.where(np.isnan(sign) | (sign == 0), tick, sign)
+
+
+# Create a function to write the trades of a symbol-day joined to the prevailing quotes as a parquet partition of the date
+
+def write_trades_quotes(trades_quotes_, dataset_dir_, date_):
+
+    partition_file = os.path.join(dataset_dir_, 'trades_quotes.parquet', 'date={}-{}-{}'.format(date_[:4], date_[4:6], date_[6:]), 'part-0.parquet')
+    os.makedirs(os.path.dirname(partition_file), exist_ok=True)
+    trades_quotes_.to_parquet(partition_file, index=False, compression='zstd')
+
+
+# Create a function to measure the peak resident memory in bytes since the last stage: on linux, the peak of the process is read from
+# VmHWM, which is reset after each stage; the child processes report their peak only once they finish, and it is counted in the stage in
+# which it rises
+
+def peak_rss():
+
+    try:
+
+        import resource
+
+    except ImportError:
+
+        return np.nan
+
+    scale = 1 if sys.platform == 'darwin' else 1024
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    if os.path.isfile('/proc/self/status'):
+
+        with open('/proc/self/status') as file:
+
+            rss = next((int(line.split()[1]) * 1024 for line in file if line.startswith('VmHWM:')), rss)
+
+    rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+    if rss_children > peak_rss_children[0]:
+
+        peak_rss_children[0] = rss_children
+        rss = max(rss, rss_children)
+
+    return rss
+
+
+# Create a function to reset the peak resident memory of the process, where supported, so that the next stage measures its own peak
+
+def reset_peak_rss():
+
+    try:
+
+        with open('/proc/self/clear_refs', 'w') as file:
+
+            file.write('5')
+
+    except OSError:
+
+        pass
+
+
+# Create a function to record the wall time, the rows in and out, the memory of the decoded frame and the peak resident memory of a stage
+# on a symbol-day: the date is stored as YYYY-MM-DD, so that it is read back as a date, and frame_bytes_ is the memory usage of the
+# dataframe decoded by the stage, not the bytes transferred from the database
+
+def record_stage(metrics_, stage_, symbol_, date_, start_, rows_in_, rows_out_, frame_bytes_=0):
+
+    date_iso = '{}-{}-{}'.format(date_[:4], date_[4:6], date_[6:]) if date_ != '' else ''
+    metrics_.append({'stage': stage_, 'symbol': symbol_, 'date': date_iso, 'wall_time': time.time() - start_, 'rows_in': int(rows_in_),
+                     'rows_out': int(rows_out_), 'frame_bytes': int(frame_bytes_), 'peak_rss': peak_rss()})
+    reset_peak_rss()
+
+
+# Create a function to write the recorded metrics of the stages to a json or csv file
+
+def write_metrics(metrics_, metrics_file_):
+
+    metrics = pd.DataFrame(metrics_, columns=['stage', 'symbol', 'date', 'wall_time', 'rows_in', 'rows_out', 'frame_bytes', 'peak_rss'])
+
+    if os.path.dirname(metrics_file_) != '':
+
+        os.makedirs(os.path.dirname(metrics_file_), exist_ok=True)
+
+    if metrics_file_.endswith('.json'):
+
+        metrics.to_json(metrics_file_, orient='records', indent=4)
+
+    else:
+
+        metrics.to_csv(metrics_file_, index=False)
@@ -21,6 +21,7 @@
 import os
 import numpy as np
 import pandas as pd
+from extract_data_functions import read_dataset
 
 
 # -------------------------------------------------------------------------------
@@ -38,7 +39,7 @@ for symbol in symbol_list:
     
     # Import the extracted datasets
 
-    data_extracted = pd.read_csv('data/mode sl/datasets/' + symbol + '/data.csv')
+    data_extracted = read_dataset('data/mode sl/datasets/' + symbol, columns_=['date', 'price'])
 
     # Create the features and target datasets
 
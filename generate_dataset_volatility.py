@@ -21,6 +21,7 @@
 import os
 import numpy as np
 import pandas as pd
+from extract_data_functions import read_dataset
 
 # -------------------------------------------------------------------------------
 # 1. PREPARE THE DATA
@@ -37,37 +38,31 @@ for symbol in symbol_list:
 
     # Import the extracted datasets
 
-    data_extracted_ori = pd.read_csv('data/mode sl/datasets/' + symbol + '/data.csv')
-    data_extracted_add = pd.read_csv('data/mode sl/datasets/' + symbol + '_addition/data.csv')
+    data_extracted = read_dataset('data/mode sl/datasets/' + symbol, columns_=['date', 'price'])
+    features_day = read_dataset('data/mode sl/datasets/' + symbol, columns_=['date', 'rv'], name_='features_day')
 
     # Create the features and target datasets
 
-    log_return_ori = np.diff(np.log(data_extracted_ori['price']))
-    data_ori = pd.DataFrame({'log_return': log_return_ori})
+    log_return = np.diff(np.log(data_extracted['price']))
+    data = pd.DataFrame({'log_return': log_return, 'date': data_extracted['date'].iloc[1:].values})
 
-    log_return_add = np.diff(np.log(data_extracted_add['price']))
-    data_add = pd.DataFrame({'log_return': log_return_add})
+    date_change = (data_extracted['date'] != data_extracted['date'].shift()).astype(int)
+    date_change = date_change.iloc[1:].reset_index(drop=True)
+    data = data[date_change == 0].reset_index(drop=True)
 
-    date_change_ori = (data_extracted_ori['date'] != data_extracted_ori['date'].shift()).astype(int)
-    date_change_ori = date_change_ori.iloc[1:].reset_index(drop=True)
-    data_ori = data_ori[date_change_ori == 0].reset_index(drop=True)
+    # Use the realized volatility of the previous day, known at the open of each day, in place of the rolling std over an additional dataset
 
-    date_change_add = (data_extracted_add['date'] != data_extracted_add['date'].shift()).astype(int)
-    date_change_add = date_change_add.iloc[1:].reset_index(drop=True)
-    data_add = data_add[date_change_add == 0].reset_index(drop=True)
+    realized_vol_prev = dict(zip(features_day['date'], np.sqrt(features_day['rv']).shift()))
+    data['log_return_rvol'] = data['date'].map(realized_vol_prev)
+    data = data[data['log_return_rvol'].notna()].drop(columns='date').reset_index(drop=True)
 
     elle = 200
-    data_ori['log_return_ma'] = data_ori['log_return'].rolling(window=elle).mean()
-    data_add['log_return_ma'] = np.NaN
-
-    data = pd.concat([data_add, data_ori])
-
-    data['log_return_mstd'] = data['log_return'].rolling(window=data_add.shape[0]).std()
+    data['log_return_ma'] = data['log_return'].rolling(window=elle).mean()
 
     Y = []
     X = []
 
-    for pos in range(data_add.shape[0] + elle, data.shape[0]):
+    for pos in range(elle, data.shape[0]):
 
         Y.append(data.iloc[pos]['log_return'])
 
@@ -78,7 +73,7 @@ for symbol in symbol_list:
         data_past['log_return_d2'] = r_diff ** 2
         data_past['log_return_d3'] = r_diff ** 3
         data_past['log_return_d4'] = r_diff ** 4
-        X.append(data_past[['log_return', 'log_return_d2', 'log_return_d3', 'log_return_d4', 'log_return_mstd']])
+        X.append(data_past[['log_return', 'log_return_d2', 'log_return_d3', 'log_return_d4', 'log_return_rvol']])
 
     Y = pd.DataFrame(Y, columns=['label'])
     X = pd.concat(X, ignore_index=True)
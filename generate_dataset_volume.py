@@ -21,6 +21,7 @@
 import os
 import numpy as np
 import pandas as pd
+from extract_data_functions import read_dataset
 
 
 # -------------------------------------------------------------------------------
@@ -38,13 +39,13 @@ for symbol in symbol_list:
 
     # Import the extracted datasets
 
-    data_extracted = pd.read_csv('data/mode sl/datasets/' + symbol + '_volume/data.csv')
+    data_extracted = read_dataset('data/mode sl/datasets/' + symbol + '_volume', columns_=['date', 'price', 'size'])
 
     # Create the features and target datasets
 
     log_return = np.diff(np.log(data_extracted['price']))
     data = pd.DataFrame({'log_return': log_return})
-    data['volume'] = data_extracted.iloc[1:, 3].reset_index(drop=True)
+    data['volume'] = data_extracted['size'].iloc[1:].reset_index(drop=True)
 
     date_change = (data_extracted['date'] != data_extracted['date'].shift()).astype(int)
     date_change = date_change.iloc[1:].reset_index(drop=True)
@@ -17,6 +17,7 @@
 import os
 import numpy as np
 import pandas as pd
+from extract_data_functions import read_dataset
 import matplotlib.pyplot as plt
 import scipy.stats
 import wrds
@@ -150,7 +151,7 @@ plt.savefig('images_document/z_qq_plots.png')
 # -------------------------------------------------------------------------------
 
 symbol = 'AAPL'
-data_extracted = pd.read_csv('data/mode sl/datasets/' + symbol + '/data.csv')
+data_extracted = read_dataset('data/mode sl/datasets/' + symbol, columns_=['price'])
 
 log_return = np.diff(np.log(data_extracted['price']))
 
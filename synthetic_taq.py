@@ -0,0 +1,274 @@
+""" synthetic_taq.py
+    ----------------
+    This script generates a synthetic tape of trades, and optionally of quotes, in local sqlite databases named as the wrds libraries and
+    tables (taqm_YYYY.ctm_YYYYMMDD, taqm_YYYY.complete_nbbo_YYYYMMDD). It also contains a local stand-in of the wrds connection, with the
+    same raw_sql and list_tables interface, which is used by 'extract_data.py' with the option -sy to run the extraction offline.
+
+    Contact: nicolo.ceneda@student.unisg.ch
+    Last update: 18 May 2020
+"""
+
+
+# ------------------------------------------------------------------------------------------------------------------------------------------
+# 0. CODE SETUP
+# ------------------------------------------------------------------------------------------------------------------------------------------
+
+
+# Import the libraries
+
+import os
+import re
+import math
+import glob
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+
+
+# Define the codes of 'tr_scond' and 'tr_corr' of the synthetic trades and their probabilities
+
+tr_scond_codes = ['@', '@F', 'F', '@ I', '@ 4', 'O', 'Q', 'M', 'G', 'T', 'Z', '@ X', 'U', 'L', 'P']
+tr_scond_prob = [0.50, 0.12, 0.08, 0.10, 0.03, 0.01, 0.01, 0.01, 0.02, 0.04, 0.02, 0.02, 0.02, 0.01, 0.01]
+tr_corr_codes = ['00', '01', '12']
+tr_corr_prob = [0.99, 0.005, 0.005]
+
+
+# Define the suffixes of the symbols queried by 'extract_data.py' with a suffix
+
+sym_suffix = {'GOOG': 'L', 'LBTY': 'K'}
+
+
+# ------------------------------------------------------------------------------------------------------------------------------------------
+# 1. LOCAL STAND-IN OF THE WRDS CONNECTION
+# ------------------------------------------------------------------------------------------------------------------------------------------
+
+
+# Create a class to query the local databases with the interface of the wrds connection: each file taqm_YYYY.db is attached as the schema
+# taqm_YYYY, the pyformat parameters %(name)s are converted to the sqlite ones, the postgres functions of the pushdown queries are converted
+# to the functions registered below, and the dates and times are returned as by wrds
+
+class Connection:
+
+    def __init__(self, db_dir_):
+
+        if not os.path.isdir(db_dir_):
+
+            raise FileNotFoundError('\nAn error occurred trying to connect to the synthetic database: {} does not exist.'.format(db_dir_))
+
+        self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+
+        for db_file in sorted(glob.glob(os.path.join(db_dir_, 'taqm_*.db'))):
+
+            self.connection.execute("ATTACH DATABASE '{}' AS {}".format(db_file, os.path.basename(db_file)[:-3]))
+
+        self.connection.create_aggregate('median', 1, Median)
+        self.connection.create_function('epoch', 1, epoch)
+        self.connection.create_function('ceil', 1, math.ceil)
+
+    def raw_sql(self, sql, params=None, chunksize=500000, return_iter=False, **kwargs):
+
+        sql = re.sub(r'%\((\w+)\)s', r':\1', sql)
+        sql = re.sub(r'PERCENTILE_CONT\(0\.5\) WITHIN GROUP \(ORDER BY (\w+)\)', r'median(\1)', sql)
+        sql = re.sub(r'EXTRACT\(EPOCH FROM (\w+)\)', r'epoch(\1)', sql)
+
+        if return_iter:
+
+            return (convert_types(chunk) for chunk in pd.read_sql_query(sql, self.connection, params=params, chunksize=chunksize))
+
+        return convert_types(pd.read_sql_query(sql, self.connection, params=params))
+
+    def list_tables(self, library):
+
+        try:
+
+            return [row[0] for row in self.connection.execute("SELECT name FROM {}.sqlite_master WHERE type = 'table'".format(library))]
+
+        except sqlite3.OperationalError:
+
+            return []
+
+    def close(self):
+
+        self.connection.close()
+
+
+# Create a class to compute the median of a group, as the postgres PERCENTILE_CONT(0.5)
+
+class Median:
+
+    def __init__(self):
+
+        self.values = []
+
+    def step(self, value):
+
+        self.values.append(value)
+
+    def finalize(self):
+
+        return float(np.median(self.values))
+
+
+# Create a function to compute the seconds since midnight of a 'time_m', as the postgres EXTRACT(EPOCH FROM time_m)
+
+def epoch(time_m_):
+
+    hours, minutes, seconds = time_m_.split(':')
+
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+# Create a function to convert the dates and times returned by sqlite as text to the python objects returned by wrds
+
+def convert_types(queried_):
+
+    if 'date' in queried_:
+
+        queried_['date'] = pd.to_datetime(queried_['date']).dt.date
+
+    if 'time_m' in queried_:
+
+        queried_['time_m'] = pd.to_datetime(queried_['time_m'], format='%H:%M:%S.%f').dt.time
+
+    return queried_
+
+
+# ------------------------------------------------------------------------------------------------------------------------------------------
+# 2. SYNTHETIC TAPE
+# ------------------------------------------------------------------------------------------------------------------------------------------
+
+
+# Create a function to format microseconds since midnight as the text of 'time_m'
+
+def format_time_m(time_us_):
+
+    hours, rest = np.divmod(time_us_, 3600 * 10 ** 6)
+    minutes, rest = np.divmod(rest, 60 * 10 ** 6)
+    seconds, micros = np.divmod(rest, 10 ** 6)
+
+    return ['{:02d}:{:02d}:{:02d}.{:06d}'.format(*t) for t in zip(hours.tolist(), minutes.tolist(), seconds.tolist(), micros.tolist())]
+
+
+# Create a function to generate the trades of a symbol on a date: the times are uniform over the trading day, with bursts of simultaneous
+# prints; the prices are a random walk on the tick grid, with isolated outliers
+
+def generate_trades(rng_, trades_per_day_, burst_prob_, outlier_prob_, price_start_):
+
+    num_trades = max(int(rng_.poisson(trades_per_day_)), 1)
+
+    time_us = np.sort(rng_.integers(34200 * 10 ** 6, 57600 * 10 ** 6, num_trades))
+    burst = rng_.random(num_trades) < burst_prob_
+    time_us = time_us[np.maximum.accumulate(np.where(burst, 0, np.arange(num_trades)))]
+
+    price = np.round(price_start_ + np.cumsum(rng_.choice([-0.01, 0, 0.01], num_trades, p=[0.3, 0.4, 0.3])), 2)
+    outlier = rng_.random(num_trades) < outlier_prob_
+    price[outlier] += np.round(rng_.choice([-1, 1], outlier.sum()) * rng_.uniform(0.5, 2, outlier.sum()) * price_start_ / 100, 2)
+
+    size = np.maximum(np.round(rng_.lognormal(4, 1, num_trades)), 1).astype('int64')
+
+    return time_us, price, size
+
+
+# Create a function to generate the national best bid and offer of a symbol on a date around the prices of its trades
+
+def generate_quotes(rng_, time_us_, price_, quotes_per_trade_):
+
+    num_quotes = max(len(time_us_) * quotes_per_trade_, 1)
+
+    quote_us = np.sort(rng_.integers(34200 * 10 ** 6 - 600 * 10 ** 6, 57600 * 10 ** 6, num_quotes))
+    mid = np.interp(quote_us, time_us_, price_)
+    half_spread = rng_.choice([0.005, 0.01, 0.02], num_quotes, p=[0.6, 0.3, 0.1])
+
+    best_bid = np.round(mid - half_spread, 3)
+    best_ask = np.round(mid + half_spread, 3)
+    best_bidsiz = rng_.integers(1, 10, num_quotes) * 100
+    best_asksiz = rng_.integers(1, 10, num_quotes) * 100
+
+    return quote_us, best_bid, best_bidsiz, best_ask, best_asksiz
+
+
+# Create a function to write the synthetic trades, and optionally quotes, of the symbols on the dates to the local databases
+
+def generate_tape(db_dir_, symbol_list_, date_list_, trades_per_day_, burst_prob_, outlier_prob_, quotes_per_trade_, seed_):
+
+    os.makedirs(db_dir_, exist_ok=True)
+
+    rng = np.random.default_rng(seed_)
+    price_start = {symbol: float(rng.uniform(20, 500)) for symbol in symbol_list_}
+
+    for date in date_list_:
+
+        date_text = '{}-{}-{}'.format(date[:4], date[4:6], date[6:])
+        connection = sqlite3.connect(os.path.join(db_dir_, 'taqm_{}.db'.format(date[:4])))
+
+        connection.execute('DROP TABLE IF EXISTS ctm_{}'.format(date))
+        connection.execute('CREATE TABLE ctm_{} (date TEXT, time_m TEXT, sym_root TEXT, sym_suffix TEXT, tr_scond TEXT, size INTEGER, '
+                           'price REAL, tr_corr TEXT)'.format(date))
+
+        if quotes_per_trade_ > 0:
+
+            connection.execute('DROP TABLE IF EXISTS complete_nbbo_{}'.format(date))
+            connection.execute('CREATE TABLE complete_nbbo_{} (date TEXT, time_m TEXT, sym_root TEXT, sym_suffix TEXT, best_bid REAL, '
+                               'best_bidsiz INTEGER, best_ask REAL, best_asksiz INTEGER)'.format(date))
+
+        for symbol in symbol_list_:
+
+            time_us, price, size = generate_trades(rng, trades_per_day_, burst_prob_, outlier_prob_, price_start[symbol])
+            price_start[symbol] = float(price[-1])
+
+            tr_scond = rng.choice(tr_scond_codes, len(time_us), p=tr_scond_prob).tolist()
+            tr_corr = rng.choice(tr_corr_codes, len(time_us), p=tr_corr_prob).tolist()
+
+            connection.executemany('INSERT INTO ctm_{} VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(date),
+                                   zip([date_text] * len(time_us), format_time_m(time_us), [symbol] * len(time_us),
+                                       [sym_suffix.get(symbol)] * len(time_us), tr_scond, size.tolist(), price.tolist(), tr_corr))
+
+            if quotes_per_trade_ > 0:
+
+                quote_us, best_bid, best_bidsiz, best_ask, best_asksiz = generate_quotes(rng, time_us, price, quotes_per_trade_)
+
+                connection.executemany('INSERT INTO complete_nbbo_{} VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(date),
+                                       zip([date_text] * len(quote_us), format_time_m(quote_us), [symbol] * len(quote_us),
+                                           [sym_suffix.get(symbol)] * len(quote_us), best_bid.tolist(), best_bidsiz.tolist(),
+                                           best_ask.tolist(), best_asksiz.tolist()))
+
+        connection.execute('CREATE INDEX ctm_{0}_sym_time ON ctm_{0} (sym_root, time_m)'.format(date))
+
+        if quotes_per_trade_ > 0:
+
+            connection.execute('CREATE INDEX complete_nbbo_{0}_sym_time ON complete_nbbo_{0} (sym_root, time_m)'.format(date))
+
+        connection.commit()
+        connection.close()
+
+        print('Generated the synthetic tape of date: {}.'.format(date_text))
+
+
+# ------------------------------------------------------------------------------------------------------------------------------------------
+# 3. COMMAND LINE INTERFACE
+# ------------------------------------------------------------------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+
+    from extract_data_functions import schedule_cached
+
+    parser = argparse.ArgumentParser(description='Command-line interface to generate a synthetic tape of trades and quotes')
+
+    parser.add_argument('-dd', '--db_dir', metavar='', type=str, default='synthetic_taq', help='Directory of the synthetic databases.')
+    parser.add_argument('-sl', '--symbol_list', metavar='', type=str, default=['AAPL'], nargs='+', help='List of symbols.')
+    parser.add_argument('-sd', '--start_date', metavar='', type=str, default='2019-03-04', help='Start date.')
+    parser.add_argument('-ed', '--end_date', metavar='', type=str, default='2019-03-08', help='End date.')
+    parser.add_argument('-nt', '--trades_per_day', metavar='', type=int, default=50000, help='Mean number of trades of a symbol per day.')
+    parser.add_argument('-bp', '--burst_prob', metavar='', type=float, default=0.2, help='Probability of a simultaneous print.')
+    parser.add_argument('-op', '--outlier_prob', metavar='', type=float, default=0.0005, help='Probability of an outlier print.')
+    parser.add_argument('-nq', '--quotes_per_trade', metavar='', type=int, default=0, help='Number of quotes per trade: 0 for no quotes.')
+    parser.add_argument('-se', '--seed', metavar='', type=int, default=0, help='Seed of the random generator.')
+
+    args = parser.parse_args()
+
+    date_list = [str(d)[:10].replace('-', '') for d in schedule_cached('NASDAQ', args.start_date, args.end_date, None, 0)]
+
+    generate_tape(args.db_dir, args.symbol_list, date_list, args.trades_per_day, args.burst_prob, args.outlier_prob, args.quotes_per_trade,
+                  args.seed)